@@ -0,0 +1,370 @@
+import numpy as np
+
+#the per species fields of the store and the value of a row which has no
+#data for a species
+SPECIES_DEFAULTS = {"source" : 0.0, "sink" : 0.0,
+                    "grid_pos" : np.nan, "value" : -1.0}
+
+#-----------------------------------------------------------------------
+#class AgentStore - keeps the per agent mechanical state in flat arrays
+class AgentStore(object):
+    """ Struct-of-arrays storage for the simulation objects. The positions,
+        radii and the displacement/constraint accumulators of every agent
+        live in contiguous (N,3)/(N,) arrays, one row per agent. The
+        gradient data of the agents lives in (N,S) arrays with one column
+        per species, S growing as new species names are seen. Objects
+        added to the store become views over their row.
+        capacity - the initial number of rows to allocate
+    """
+
+    def __init__(self, capacity = 1024):
+        #the number of rows currently in use
+        self.n = 0
+        #counts changes to the agent positions, to know when derived data
+        #such as the center is stale
+        self.version = 0
+        self._capacity = max(int(capacity), 1)
+        #the objects, ordered by their row in the store
+        self.objects = []
+        #allocate the arrays
+        self._arrays = dict()
+        self._arrays["location"] = np.zeros((self._capacity, 3))
+        self._arrays["radius"] = np.zeros(self._capacity)
+        self._arrays["disp"] = np.zeros((self._capacity, 3))
+        self._arrays["fixed"] = np.zeros((self._capacity, 3))
+        #how far each agent moved in its last constraint update
+        self._arrays["residual"] = np.zeros(self._capacity)
+        #the interaction table type code of each agent
+        self._arrays["type"] = np.zeros(self._capacity, dtype=np.intp)
+        #maps a species (gradient) name to its column
+        self.species = dict()
+        self._arrays["source"] = np.zeros((self._capacity, 0))
+        self._arrays["sink"] = np.zeros((self._capacity, 0))
+        self._arrays["grid_pos"] = np.zeros((self._capacity, 0, 3))
+        self._arrays["value"] = np.zeros((self._capacity, 0))
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def location(self):
+        """ The (N,3) array of agent positions
+        """
+        return self._arrays["location"][:self.n]
+
+    @property
+    def radius(self):
+        """ The (N,) array of agent radii
+        """
+        return self._arrays["radius"][:self.n]
+
+    @property
+    def disp(self):
+        """ The (N,3) array of accumulated spring displacements
+        """
+        return self._arrays["disp"][:self.n]
+
+    @property
+    def fixed(self):
+        """ The (N,3) array of accumulated fixed/collision constraints
+        """
+        return self._arrays["fixed"][:self.n]
+
+    @property
+    def residual(self):
+        """ The (N,) array of how far each agent moved in its last
+            constraint update, inf for agents which have not been updated
+        """
+        return self._arrays["residual"][:self.n]
+
+    @property
+    def type(self):
+        """ The (N,) array of agent type codes in the interaction table
+        """
+        return self._arrays["type"][:self.n]
+
+    @property
+    def source(self):
+        """ The (N,S) array of source coefficients of each species
+        """
+        return self._arrays["source"][:self.n]
+
+    @property
+    def sink(self):
+        """ The (N,S) array of sink coefficients of each species
+        """
+        return self._arrays["sink"][:self.n]
+
+    @property
+    def grid_pos(self):
+        """ The (N,S,3) array of agent positions on each species grid, nan
+            where unknown
+        """
+        return self._arrays["grid_pos"][:self.n]
+
+    @property
+    def value(self):
+        """ The (N,S) array of gradient values at each agent, -1 where
+            unknown
+        """
+        return self._arrays["value"][:self.n]
+
+    def species_column(self, name):
+        """ Returns the column of the species name, adding a column of
+            defaults to the species arrays if it is new. Adding a column
+            reallocates the arrays, so new species must not be added while
+            other threads write to them.
+        """
+        if(name not in self.species):
+            for key in SPECIES_DEFAULTS.keys():
+                old = self._arrays[key]
+                col = np.empty(old.shape[:1] + (1,) + old.shape[2:])
+                col[:] = SPECIES_DEFAULTS[key]
+                self._arrays[key] = np.concatenate((old, col), axis=1)
+            self.species[name] = len(self.species)
+        return self.species[name]
+
+    def load_species(self, row, coeff, position, value):
+        """ Copies the gradient dicts of a detached object in to row
+            coeff - maps names to (source, sink) tuples
+            position - maps names to (x, y, z) grid positions
+            value - maps names to gradient values
+        """
+        arrays = self._arrays
+        for name in coeff.keys():
+            col = self.species_column(name)
+            arrays["source"][row, col] = coeff[name][0]
+            arrays["sink"][row, col] = coeff[name][1]
+        for name in position.keys():
+            arrays["grid_pos"][row, self.species_column(name)] = position[name]
+        for name in value.keys():
+            arrays["value"][row, self.species_column(name)] = value[name]
+
+    def species_dicts(self, row):
+        """ Returns the gradient data of row as the (coeff, position, value)
+            dicts of a detached object, leaving out the defaults
+        """
+        arrays = self._arrays
+        coeff = dict()
+        position = dict()
+        value = dict()
+        for name, col in self.species.items():
+            source = arrays["source"][row, col]
+            sink = arrays["sink"][row, col]
+            if(source != 0 or sink != 0):
+                coeff[name] = (source, sink)
+            pos = arrays["grid_pos"][row, col]
+            if(not np.any(np.isnan(pos))):
+                position[name] = tuple(pos)
+            if(arrays["value"][row, col] != -1):
+                value[name] = arrays["value"][row, col]
+        return coeff, position, value
+
+    def _grow(self):
+        """ Doubles the capacity of all the arrays in the store
+        """
+        self._capacity *= 2
+        for key in self._arrays.keys():
+            old = self._arrays[key]
+            new = np.zeros((self._capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            self._arrays[key] = new
+
+    def add(self, sim_object):
+        """ Adds an object to the end of the store and attaches it to its row
+            returns - the row index of the object
+        """
+        if(self.n == self._capacity):
+            self._grow()
+        row = self.n
+        #copy the local values in to the row
+        self._arrays["location"][row] = sim_object._location_local
+        self._arrays["radius"][row] = sim_object._radius_local
+        self._arrays["disp"][row] = sim_object._disp_local
+        self._arrays["fixed"][row] = sim_object._fixed_local
+        #new agents have not settled yet
+        self._arrays["residual"][row] = np.inf
+        self._arrays["type"][row] = sim_object._interaction_code()
+        for key in SPECIES_DEFAULTS.keys():
+            self._arrays[key][row] = SPECIES_DEFAULTS[key]
+        self.objects.append(sim_object)
+        self.n += 1
+        self.version += 1
+        sim_object._attach(self, row)
+        return row
+
+    def remove(self, sim_object):
+        """ Removes an object from the store. The last row is moved in to
+            the freed row so the arrays stay contiguous.
+            returns - a tuple of (row, last) where last is the row that was
+                      moved in to row (equal to row if nothing moved)
+        """
+        row = sim_object._index
+        last = self.n - 1
+        #copy the values back to the object before detaching it
+        sim_object._detach()
+        if(row != last):
+            for key in self._arrays.keys():
+                self._arrays[key][row] = self._arrays[key][last]
+            moved = self.objects[last]
+            moved._index = row
+            self.objects[row] = moved
+        self.objects.pop()
+        #clear the old last row
+        for key in self._arrays.keys():
+            self._arrays[key][last] = 0
+        self.n -= 1
+        self.version += 1
+        return row, last
+
+    def index_of(self, objects):
+        """ Returns the row indices of a sequence of objects as an int array
+        """
+        return np.fromiter((obj._index for obj in objects), dtype=np.intp,
+                           count=len(objects))
+
+    def update_constraints(self, max_step = 5.0, active = None):
+        """ Vectorized version of SimulationObject.update_constraints. Moves
+            every agent by its displacement and then by its fixed
+            constraint vector, each clamped to max_step, then clears both
+            accumulators and records how far each agent moved.
+            active - optional int array of rows, only these agents are moved
+                     and the accumulators of the others are discarded
+        """
+        if(active is None):
+            active = slice(0, self.n)
+        location = self.location
+        step = 0
+        for key in ("disp", "fixed"):
+            vec = self._arrays[key][:self.n]
+            move = vec[active]
+            mag = np.sqrt(np.einsum("ij,ij->i", move, move))
+            over = mag > max_step
+            if(np.any(over)):
+                move[over] *= (max_step / mag[over])[:, None]
+                mag[over] = max_step
+            location[active] += move
+            step = step + mag
+            vec[:] = 0
+        self.residual[active] = step
+        self.version += 1
+
+#-----------------------------------------------------------------------
+#class FixedConstraints - array backed list of fixed pair constraints
+class FixedConstraints(object):
+    """ Keeps the fixed immutable constraints between agents as a (M,2)
+        array of store rows with a rest length for each constraint.
+        Constraints are indexed by agent ID so adding, removing and
+        remapping rows are amortized O(1) per constraint.
+        capacity - the initial number of constraints to allocate
+    """
+
+    def __init__(self, capacity = 64):
+        #the number of constraints in use
+        self.m = 0
+        self._capacity = max(int(capacity), 1)
+        self._pairs = np.zeros((self._capacity, 2), dtype=np.intp)
+        self._rest = np.zeros(self._capacity)
+        #the (ID, ID) key for each slot
+        self._keys = []
+        #maps a (ID, ID) key to its slot
+        self._slot = dict()
+        #maps an agent ID to the set of slots it is part of
+        self._by_id = dict()
+
+    def __len__(self):
+        return self.m
+
+    @property
+    def i(self):
+        """ The (M,) array of first rows of each constraint
+        """
+        return self._pairs[:self.m, 0]
+
+    @property
+    def j(self):
+        """ The (M,) array of second rows of each constraint
+        """
+        return self._pairs[:self.m, 1]
+
+    @property
+    def rest(self):
+        """ The (M,) array of constraint rest lengths
+        """
+        return self._rest[:self.m]
+
+    def _key(self, obj1, obj2):
+        """ Returns the order independent key of a pair of agents
+        """
+        if(obj1.ID <= obj2.ID):
+            return (obj1.ID, obj2.ID)
+        return (obj2.ID, obj1.ID)
+
+    def add(self, obj1, obj2, rest):
+        """ Adds a constraint between the attached agents obj1 and obj2 with
+            the given rest length. Re-adding a pair updates its rest length.
+        """
+        key = self._key(obj1, obj2)
+        if(key in self._slot):
+            self._rest[self._slot[key]] = rest
+            return
+        if(self.m == self._capacity):
+            self._capacity *= 2
+            pairs = np.zeros((self._capacity, 2), dtype=np.intp)
+            pairs[:self.m] = self._pairs[:self.m]
+            self._pairs = pairs
+            rest_lengths = np.zeros(self._capacity)
+            rest_lengths[:self.m] = self._rest[:self.m]
+            self._rest = rest_lengths
+        slot = self.m
+        self._pairs[slot] = (obj1._index, obj2._index)
+        self._rest[slot] = rest
+        self._keys.append(key)
+        self._slot[key] = slot
+        self._by_id.setdefault(obj1.ID, set()).add(slot)
+        self._by_id.setdefault(obj2.ID, set()).add(slot)
+        self.m += 1
+
+    def _remove_slot(self, slot):
+        """ Removes the constraint in slot by moving the last one in to it
+        """
+        key = self._keys[slot]
+        for ID in set(key):
+            self._by_id[ID].discard(slot)
+            if(len(self._by_id[ID]) == 0):
+                del self._by_id[ID]
+        del self._slot[key]
+        last = self.m - 1
+        if(slot != last):
+            moved = self._keys[last]
+            self._pairs[slot] = self._pairs[last]
+            self._rest[slot] = self._rest[last]
+            self._keys[slot] = moved
+            self._slot[moved] = slot
+            for ID in set(moved):
+                self._by_id[ID].discard(last)
+                self._by_id[ID].add(slot)
+        self._keys.pop()
+        self.m -= 1
+
+    def remove(self, obj1, obj2):
+        """ Removes the constraint between obj1 and obj2
+            ERRORS - KeyError if there is no such constraint
+        """
+        self._remove_slot(self._slot[self._key(obj1, obj2)])
+
+    def remove_object(self, obj):
+        """ Removes all the constraints the agent obj is part of
+        """
+        slots = self._by_id.get(obj.ID, None)
+        while(slots):
+            self._remove_slot(max(slots))
+            slots = self._by_id.get(obj.ID, None)
+
+    def move_row(self, obj, old_row, new_row):
+        """ Updates the constraints of obj after the agent store moved it
+            from old_row to new_row
+        """
+        for slot in self._by_id.get(obj.ID, ()):
+            pair = self._pairs[slot]
+            pair[pair == old_row] = new_row
@@ -54,8 +54,4 @@ class DividingCell(SimulationObject):
             self.division_timer = 0
 
 
-    def get_interaction_length(self):
-        """ Gets the interaciton elngth for the cell. Overiides parent
-            Returns - the length of any interactions with this cell (float)
-        """
-        return self.radius + 2.0 #in um
+DividingCell.register_interaction_type(length_offset = 2.0)
@@ -1,9 +1,25 @@
 import numpy as np
 from scipy import ndimage
 from scipy.interpolate import griddata
+from scipy.linalg import solve_banded
+from scipy import sparse
+from scipy.sparse.linalg import cg
+from scipy.fft import dstn
 import math
 import pickle
 
+#the diffusion solvers a gradient can use
+SOLVERS = ("explicit", "adi", "steady", "spectral")
+#how the sink arrays are applied, fixed rates or saturating uptake
+UPTAKES = ("linear", "michaelis_menten")
+#the spline orders the object interpolation can use
+INTERP_ORDERS = (1, 3, 5)
+#the number of voxels the explicit active region is padded and grown by
+ACTIVE_MARGIN = 4
+#the factor the adi time steps grow by, from the explicit time step up to
+#implicit_dt
+ADI_GROWTH = 1.5
+
 #-----------------------------------------------------------------------
 #class Gradient - creates a gradient for a certain object
 class Gradient(object):
@@ -14,10 +30,64 @@ class Gradient(object):
         dx, dy, dz - the spatial resolution of each grid step
         outside_c - the value fo the gradient outside the box
         unit_vol = the uinit vole in L (ul) m or um
+        solver - "explicit" for forward Euler at the stable time step, or
+                 "adi" for unconditionally stable Crank-Nicolson steps split
+                 along each axis (tridiagonal solves), "steady" to solve
+                 directly for the steady state with solve_steady_state, or
+                 "spectral" to propagate the whole update exactly in a
+                 sine transform basis (constant D on the box)
+        implicit_dt - the longest time step (sec) used by the "adi" solver,
+                      with the default an hour stays within 1e-3 of the
+                      max concentration of an exact solve
+        check_every - the number of explicit steps between convergence checks
+        dtype - the floating point type the concentrations are stored and
+                solved in
+        active_region_tol - if set, the explicit solver only updates a box
+                            around the sinks, sources and voxels which
+                            differ from outside_c by more than this
+        uptake - "linear" to remove the sink as a fixed rate, or
+                 "michaelis_menten" to treat the sink as the max uptake
+                 rate Vmax, removing Vmax*C/(km + C). The "explicit"
+                 solver applies it semi-implicitly, the "adi" and "steady"
+                 solvers solve it with Newton-Krylov, and the "spectral"
+                 solver does not support it.
+        km - the Michaelis-Menten constant (same units as C)
+        interp_order - the spline order (1, 3 or 5) used to interpolate the
+                       gradient at the object locations
+        ERRORS - ValueError if the solver, uptake or interpolation order is
+                 not recognized, or the uptake is not supported by the solver
     """
 
+    #whether the gradient can be solved as part of a GradientSet
+    batchable = True
+
     def __init__(self, name, D, x, y, z, dx, dy, dz,
-                 outside_c = 0.0, vol_units = 1e-6):
+                 outside_c = 0.0, vol_units = 1e-6,
+                 solver = "explicit", implicit_dt = 600.0, check_every = 10,
+                 dtype = np.float32, active_region_tol = None,
+                 uptake = "linear", km = 0.0, interp_order = 5):
+        if(solver not in SOLVERS):
+            raise ValueError("Unknown diffusion solver " + repr(solver))
+        if(uptake not in UPTAKES):
+            raise ValueError("Unknown uptake " + repr(uptake))
+        if(uptake == "michaelis_menten"):
+            if(solver == "spectral"):
+                raise ValueError("The " + repr(solver) + " solver does not" +
+                                 " support Michaelis-Menten uptake")
+            if(km <= 0):
+                raise ValueError("km must be positive")
+        self.uptake = uptake
+        self.km = float(km)
+        if(interp_order not in INTERP_ORDERS):
+            raise ValueError("Unknown interpolation order " + repr(interp_order))
+        self.interp_order = interp_order
+        self.dtype = np.dtype(dtype)
+        self.active_region_tol = active_region_tol
+        self.solver = solver
+        self.implicit_dt = float(implicit_dt)
+        self.check_every = max(int(check_every), 1)
+        #derived data which is rebuilt on demand and never saved
+        self._cache = dict()
         #save the unit volume
         self._vol_units = 1e-6
         #save the name
@@ -44,33 +114,21 @@ class Gradient(object):
         self.dt = .5 / ((D/dx2) + (D/dy2) + (D/dz2))
         print(self.dt)
         #set the iniatil conditions
-        self.Ci = np.zeros((self.x_dim, self.y_dim, self.z_dim))*outside_c
-        self.C = np.zeros((self.x_dim, self.y_dim, self.z_dim))
+        self.Ci = np.zeros((self.x_dim, self.y_dim, self.z_dim),
+                           dtype=self.dtype)*outside_c
+        self.C = np.zeros((self.x_dim, self.y_dim, self.z_dim),
+                          dtype=self.dtype)
         #set the boundary conditions
         self._c_out = outside_c
         #compute the unit volume
         self._grid_vol = (self._vol_units **3)* self._dx * self._dy * self._dz
-        #define the discrete laplacian operator
-##        self._laplacian = np.array([[[0,0,0],[0,1/dz2,0],[0,0,0]],
-##                    [[0,1/dy2,0],[1/dx2,-6/(dx2+dy2+dz2),1/dx2],[0,1/dy2,0]],
-##                    [[0,0,0],[0,1/dz2,0],[0,0,0]]])
-        self._lz = np.array([[[0,0,0],[0,1./dz2,0],[0,0,0]],
-                    [[0,0,0],[0,-2./(dz2),0],[0,0,0]],
-                    [[0,0,0],[0,1./dz2,0],[0,0,0]]])
-        self._ly = np.array([[[0,0,0],[0,0,0],[0,0,0]],
-                    [[0,1./dy2,0],[0,-2./(dy2),0],[0,1./dy2,0]],
-                    [[0,0,0],[0,0,0],[0,0,0]]])
-        self._lx = np.array([[[0,0,0],[0,0,0],[0,0,0]],
-                    [[0,0,0],[1./dx2,-2./(dx2),1./dx2],[0,0,0]],
-                    [[0,0,0],[0,0,0],[0,0,0]]])
-
 
     def set_initial_conditions(self, mask):
         """ Will set the inital conditions everywhere a zero exsists
             in the mask, to the c_out parameter specified
             during the gradient creation
         """
-        self.Ci = (mask == 0)*self._c_out
+        self.Ci = ((mask == 0)*self._c_out).astype(self.dtype)
         
     def save(self, base_path, time_stamp):
         """ Saves the gradients to a binary numpy file
@@ -87,30 +145,94 @@ class Gradient(object):
         f.close()
         return path
 
+    def __getstate__(self):
+        """ Pickles the gradient without its cached solver data
+        """
+        state = self.__dict__.copy()
+        state["_cache"] = dict()
+        return state
+
+    def __setstate__(self, state):
+        """ Restores a pickled gradient, including ones saved before the
+            solver options existed
+        """
+        state.setdefault("solver", "explicit")
+        state.setdefault("implicit_dt", 600.0)
+        state.setdefault("check_every", 10)
+        #older gradients were always double precision
+        state.setdefault("dtype", np.dtype(np.float64))
+        state.setdefault("active_region_tol", None)
+        state.setdefault("uptake", "linear")
+        state.setdefault("km", 0.0)
+        state.setdefault("interp_order", 5)
+        state["_cache"] = dict()
+        self.__dict__.update(state)
+
     def shape(self):
         """ Returns the shape of the array
         """
         return (self.x_dim, self.y_dim, self.z_dim)
 
+    def _spline_coefficients(self):
+        """ Returns the B-spline coefficients of C for interp_order, computed
+            once after every update
+        """
+        if("spline" not in self._cache):
+            if(self.interp_order > 1):
+                coeffs = ndimage.spline_filter(self.C, order=self.interp_order,
+                                               output=self.dtype,
+                                               mode="reflect")
+            else:
+                #linear interpolation needs no prefilter
+                coeffs = self.C
+            self._cache["spline"] = coeffs
+        return self._cache["spline"]
+
+    def interpolate_at_grid_positions(self, points):
+        """ Performs a spline interpolation of interp_order of the whole
+            data set at many grid positions at once
+            points - (N,3) array of positions from get_object_position_on_grid
+            returns - the (N,) array of values
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        #voxel k covers the positions k to k+1, so its center is at k+0.5
+        cords = points.T - 0.5
+        #get the interpolated values
+        return ndimage.map_coordinates(self._spline_coefficients(), cords,
+                                       order=self.interp_order,
+                                       mode="reflect", prefilter=False)
+
+    def _voxel_indices(self, points):
+        """ Returns the (N,3) int voxel indices of the (N,3) grid positions,
+            negative indices wrap like they do when indexing the arrays
+            directly
+        """
+        idx = points.astype(np.intp)
+        idx += (idx < 0) * np.array(self.Ci.shape)
+        return idx
+
+    def sum_at_grid_positions(self, points, weights = None):
+        """ Sums values in to the voxels holding many grid positions at once
+            points - (N,3) array of positions from get_object_position_on_grid
+            weights - the (N,) values to sum, or None to count the points
+            returns - the summed array, in the form update and
+                      set_initial_conditions take
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        shp = self.Ci.shape
+        flat = np.ravel_multi_index(self._voxel_indices(points).T, shp)
+        return np.bincount(flat, weights=weights,
+                           minlength=int(np.prod(shp))).reshape(shp)
+
     def cubic_interpolate_at_object_locations(self, agents):
         """ Performs an interpolation of the whole data set
-            based on a cubic intepolation, at all the specified points
+            based on a spline intepolation of interp_order, at all the
+            specified points
         """
         #get all the agent locations
-        points = []
-        for i in range(0, len(agents)):
-            #get the indicies of the gradient
-            pos = agents[i].get_gradient_location(self.name)
-            x = int(pos[0])
-            y = int(pos[1])
-            z = int(pos[2])
-            points.append([x,y,z])
-        #Now convert the points to an array
-        points = np.array(points)
-        #transpose it to the correct format
-        cords = points.T
-        #get the interpolated values
-        zi = ndimage.map_coordinates(self.C, cords, order=5, mode='reflect')
+        points = np.array([agents[i].get_gradient_location(self.name)
+                           for i in range(0, len(agents))], dtype=float)
+        zi = self.interpolate_at_grid_positions(points)
         #set all the agents values
         for i in range(0, len(agents)):
             #now set the gradient value at this point
@@ -120,17 +242,21 @@ class Gradient(object):
         """ Assumes the distance vector is assigned as a vector pointing from
             the center out towards the point to index. Will return an error if
             point is outside the range of the grid
+            distance - a vector, or an (N,3) array of vectors
+            returns - the x, y, z position for a vector, or the (N,3) array
+                      of positions for an array of vectors
         """
+        distance = np.asarray(distance, dtype=float)
         #now we know the spatial resolution per grid spacing
-        dx = distance[0] / self._dx
-        dy = distance[1] / self._dy
-        dz = distance[2] / self._dz
+        spacing = np.array([self._dx, self._dy, self._dz])
         #get the center loction
-        cx = int(self.x_dim / 2)
-        cy = int(self.y_dim / 2)
-        cz = int(self.z_dim / 2)
-        #return the x, y, z indicies to add at
-        return cx + dx, cy + dy, cz + dz
+        center = np.array([int(self.x_dim / 2), int(self.y_dim / 2),
+                           int(self.z_dim / 2)])
+        pos = center + distance / spacing
+        if(pos.ndim == 1):
+            #return the x, y, z indicies to add at
+            return pos[0], pos[1], pos[2]
+        return pos
 
     def get_gradient_value_at_point(self, point):
         """ Will get the gradient value at a specific point. Useful for
@@ -138,84 +264,472 @@ class Gradient(object):
             Assume the point is a distance vector representing the radius
             of the cell within the strutural aggregate
         """
-        x, y, z = self.get_object_position_on_grid(point)
-        #get the indices
-        ix = int(x)
-        iy = int(y)
-        iz = int(z)
-        #perform a trilinear interpolation from wikipedia.org
-        #x
-        if(x - ix > .5):
-            x0 = ix
-            x1 = ix + 1
-        else:
-            x0 = ix - 1
-            x1 = ix
-        #y
-        if(y - iy > .5):
-            y0 = iy
-            y1 = iy + 1
-        else:
-            y0 = iy - 1
-            y1 = iy
-        #z
-        if(z - iz > .5):
-            z0 = iz
-            z1 = iz + 1
+        return self.sample([point])[0]
+
+    def _padded_field(self):
+        """ Returns C padded with one voxel of the outside concentration
+        """
+        if("padded" not in self._cache):
+            self._cache["padded"] = np.pad(self.C, 1, mode="constant",
+                                           constant_values=self._c_out)
+        return self._cache["padded"]
+
+    def _field_changed(self):
+        """ Drops the data derived from C, called whenever C is replaced
+        """
+        self._cache.pop("spline", None)
+        self._cache.pop("padded", None)
+
+    def sample(self, points, outside = "clamp"):
+        """ Trilinear interpolation of the gradient at many points at once.
+            Voxel values sit at the voxel centers.
+            points - (N,3) array of distance vectors from the center, like
+                     the ones given to get_object_position_on_grid
+            outside - how points past the outer voxel centers are handled,
+                      "clamp" to use the nearest values on the grid or
+                      "outside_c" to blend towards the outside
+                      concentration, reached one voxel past the edge
+            returns - the (N,) array of values
+            ERRORS - ValueError if outside is not recognized
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        #this gradient's own grid, even for subclasses which map objects
+        #on to another level
+        coords = Gradient.get_object_position_on_grid(self, points).T
+        if(outside == "clamp"):
+            C = self.C
+            #voxel k covers the positions k to k+1
+            coords -= 0.5
+        elif(outside == "outside_c"):
+            C = self._padded_field()
+            coords += 0.5
         else:
-            z0 = iz - 1
-            z1 = iz                       
-            
-        #solve for xd, yd, zd
-        xd = (abs(x - (ix + .5))) / (x1 - x0)
-        yd = (abs(y - (iy + .5))) / (y1 - y0)
-        zd = (abs(z - (iz + .5))) / (z1 - z0)
-
-        #now the first set of linear interp
-        c00 = self.C[x0, y0, z0]*(1 - xd) + self.C[x1, y0, z0]*xd
-        c10 = self.C[x0, y1, z0]*(1 - xd) + self.C[x1, y1, z0]*xd
-        c01 = self.C[x0, y0, z1]*(1 - xd) + self.C[x1, y0, z1]*xd
-        c11 = self.C[x0, y1, z1]*(1 - xd) + self.C[x1, y1, z1]*xd
-
-        #now the second set
-        c0 = c00*(1-yd) + c10*yd
-        c1 = c01*(1-yd) + c11*yd
-        #finally the last set
-        c = c0*(1-zd) + c1*zd
-        #return the predicted value
-        return c
+            raise ValueError("Unknown outside handling " + repr(outside))
+        hi = np.array(C.shape)[:, None] - 1
+        coords = np.clip(coords, 0, hi)
+        #the lower corner of the cell each point lies in
+        lo = np.minimum(np.floor(coords).astype(np.intp),
+                        np.maximum(hi - 1, 0))
+        f = coords - lo
+        up = np.minimum(lo + 1, hi)
+        values = np.zeros(coords.shape[1])
+        for cx, wx in ((lo[0], 1.0 - f[0]), (up[0], f[0])):
+            for cy, wy in ((lo[1], 1.0 - f[1]), (up[1], f[1])):
+                for cz, wz in ((lo[2], 1.0 - f[2]), (up[2], f[2])):
+                    values += C[cx, cy, cz] * (wx*wy*wz)
+        return values
     
     def update(self, t_end, sink, source):
+        """ Solves the system with the gradient's solver until the end time
+            of the simulation is reached.
+            t_end - the end time to solve the system towards
+        """
+        if(self.solver == "adi"):
+            self._update_adi(t_end, sink, source)
+        elif(self.solver == "steady"):
+            self.solve_steady_state(sink, source)
+        elif(self.solver == "spectral"):
+            self._update_spectral(t_end, sink, source)
+        else:
+            self._update_explicit(t_end, sink, source)
+        #C has changed
+        self._field_changed()
+
+    def _rates(self, dt, sink, source):
+        """ Returns the (rate, vmax) concentration changes over dt. rate is
+            the fixed change from the sources and linear sinks. vmax is None
+            for linear uptake, otherwise the max uptake over dt, which the
+            explicit solver applies semi-implicitly by dividing by
+            1 + vmax/(km + C) with C from the start of the step.
+        """
+        #MUST BE normalized by unit VOLUME
+        if(self.uptake == "michaelis_menten"):
+            rate = (source*dt / self._grid_vol).astype(self.dtype)
+            vmax = (sink*dt / self._grid_vol).astype(self.dtype)
+            return rate, vmax
+        return ((source - sink)*dt / self._grid_vol).astype(self.dtype), None
+
+    def _steady_state_matrix(self):
+        """ Returns the sparse matrix of -D times the 7-point laplacian with
+            the outside concentration as a Dirichlet boundary. Symmetric
+            positive definite, so it can be solved with conjugate gradient.
+        """
+        if("steady_matrix" not in self._cache):
+            ops = []
+            for n, h in ((self.x_dim, self._dx), (self.y_dim, self._dy),
+                         (self.z_dim, self._dz)):
+                d2 = sparse.diags([np.ones(n-1), -2*np.ones(n), np.ones(n-1)],
+                                  [-1, 0, 1]) / h**2
+                ops.append(d2)
+            ix = sparse.identity(self.x_dim)
+            iy = sparse.identity(self.y_dim)
+            iz = sparse.identity(self.z_dim)
+            #C order raveling, z varies the fastest
+            lap = (sparse.kron(sparse.kron(ops[0], iy), iz) +
+                   sparse.kron(sparse.kron(ix, ops[1]), iz) +
+                   sparse.kron(sparse.kron(ix, iy), ops[2]))
+            self._cache["steady_matrix"] = (-self._D*lap).tocsr()
+        return self._cache["steady_matrix"]
+
+    def solve_steady_state(self, sink, source, tol = 1e-8, maxiter = 1000):
+        """ Solves directly for the steady state of the gradient with the
+            given sink and source terms, D*laplacian(C) + source - sink = 0,
+            with conjugate gradient warm started from the current C.
+            tol - the relative residual tolerance
+            maxiter - the max number of iterations
+            returns - the number of iterations used
+        """
+        if(self.uptake == "michaelis_menten"):
+            return self._solve_uptake(sink, source, None, tol, maxiter)
+        A = self._steady_state_matrix()
+        #MUST BE normalized by unit VOLUME
+        rhs = (source - sink) / self._grid_vol + self._boundary_flux()
+        #always solved in double precision, the tolerance is finer than
+        #single precision can resolve
+        x0 = np.array(self.Ci, dtype=float).ravel()
+        C, itrs = self._cg(A, rhs.ravel(), x0, tol, maxiter)
+        C = C.reshape(self.Ci.shape).astype(self.dtype)
+        #make sure its positive
+        self.C = C * (C > 0.0)
+        self.Ci = self.C
+        return itrs
+
+    def _boundary_flux(self):
+        """ Returns D times the laplacian of a zero field with the outside
+            concentration past the edges, the flux in from outside
+        """
+        zeros = np.zeros(self.Ci.shape)
+        flux = zeros
+        for axis in range(0, 3):
+            flux = flux + self._axis_laplacian(zeros, axis, self._c_out)
+        return flux*self._D
+
+    def _cg(self, A, b, x0, tol, maxiter):
+        """ Solves A x = b with conjugate gradient from x0
+            returns - a tuple of (x, number of iterations)
+        """
+        itrs = [0]
+        def count(x):
+            itrs[0] += 1
+        try:
+            x, info = cg(A, b, x0=x0, rtol=tol, maxiter=maxiter,
+                         callback=count)
+        except TypeError:
+            #older scipy names the tolerance tol
+            x, info = cg(A, b, x0=x0, tol=tol, maxiter=maxiter,
+                         callback=count)
+        return x, itrs[0]
+
+    def _solve_uptake(self, sink, source, dt = None, tol = 1e-8,
+                      maxiter = 1000, newton_steps = 20):
+        """ Solves for the gradient with Michaelis-Menten uptake, the sink
+            being Vmax, with Newton-Krylov: Newton steps on the nonlinear
+            system with every linear solve done by conjugate gradient.
+            The jacobian stays symmetric positive definite since the uptake
+            only grows with C.
+            dt - the backward Euler time step, or None for the steady state
+            tol - the relative residual tolerance of the Newton and CG steps
+            maxiter - the max number of CG iterations per Newton step
+            newton_steps - the max number of Newton steps
+            returns - the total number of CG iterations used
+        """
+        A = self._steady_state_matrix()
+        #MUST BE normalized by unit VOLUME
+        b = (source / self._grid_vol + self._boundary_flux()).ravel()
+        vmax = (sink / self._grid_vol).ravel()
+        C = np.array(self.Ci, dtype=float).ravel()
+        if(dt is not None):
+            A = (A + sparse.identity(len(C)) / dt).tocsr()
+            b = b + C / dt
+        scale = max(np.linalg.norm(b), np.linalg.norm(vmax), 1e-300)
+        itrs = 0
+        for step in range(0, newton_steps):
+            uptake = vmax*C / (self.km + C)
+            F = A.dot(C) + uptake - b
+            if(np.linalg.norm(F) <= tol*scale):
+                break
+            J = (A + sparse.diags(vmax*self.km / (self.km + C)**2)).tocsr()
+            dC, n = self._cg(J, -F, None, tol, maxiter)
+            itrs += n
+            #the uptake is only defined for positive concentrations
+            C = np.maximum(C + dC, 0.0)
+        C = C.reshape(self.Ci.shape).astype(self.dtype)
+        self.C = C
+        self.Ci = self.C
+        return itrs
+
+    def _spectral_factors(self, t_end):
+        """ Returns the (decay, gain) factors of the sine modes over t_end.
+            The type I sine transform diagonalizes the 7-point laplacian
+            with a fixed value past the edges, with eigenvalue lam. A mode
+            then decays by exp(D*lam*t) and a constant source gains
+            (exp(D*lam*t) - 1) / (D*lam).
+        """
+        key = ("spectral", t_end)
+        if(key not in self._cache):
+            lams = []
+            for n, h in ((self.x_dim, self._dx), (self.y_dim, self._dy),
+                         (self.z_dim, self._dz)):
+                k = np.arange(1, n + 1)
+                lams.append(-(4.0/h**2)*np.sin(np.pi*k / (2.0*(n + 1)))**2)
+            rate = self._D*(lams[0][:, None, None] + lams[1][None, :, None] +
+                            lams[2][None, None, :])
+            decay = np.exp(rate*t_end)
+            #drop factors for other end times
+            for old in [k for k in self._cache.keys() if k[0] == "spectral"]:
+                del self._cache[old]
+            self._cache[key] = (decay.astype(self.dtype),
+                                ((decay - 1.0) / rate).astype(self.dtype))
+        return self._cache[key]
+
+    def _update_spectral(self, t_end, sink, source):
+        """ Advances the system by t_end in one sine transform pair. The
+            deviation from the outside concentration is zero past the edges
+            so it is expanded in sine modes, each of which is propagated
+            exactly, including the time integrated sink and source terms.
+            Negative values are only clipped at the end.
+        """
+        decay, gain = self._spectral_factors(float(t_end))
+        #MUST BE normalized by unit VOLUME
+        rate = ((source - sink) / self._grid_vol).astype(self.dtype)
+        u_hat = dstn(np.asarray(self.Ci, dtype=self.dtype) - self._c_out,
+                     type=1, norm="ortho")
+        s_hat = dstn(rate, type=1, norm="ortho")
+        #the orthonormal type I transform is its own inverse
+        C = dstn(decay*u_hat + gain*s_hat, type=1, norm="ortho")
+        C += self._c_out
+        #make sure its positive
+        self.C = C * (C > 0.0)
+        self.Ci = self.C
+
+    def _axis_laplacian(self, C, axis, c_out):
+        """ Returns the second difference of C along one axis, using c_out
+            past the edges of the grid
+        """
+        h = (self._dx, self._dy, self._dz)[axis]
+        Ct = np.moveaxis(C, axis, 0)
+        lap = -2.0*Ct
+        lap[1:] += Ct[:-1]
+        lap[:-1] += Ct[1:]
+        lap[0] += c_out
+        lap[-1] += c_out
+        return np.moveaxis(lap, 0, axis) / h**2
+
+    def _axis_matrix(self, axis, a):
+        """ Returns the banded (I - a*d2) matrix for the implicit part of a
+            step along an axis, in solve_banded form
+        """
+        n = self.Ci.shape[axis]
+        ab = np.zeros((3, n), dtype=self.dtype)
+        ab[0, 1:] = -a
+        ab[1, :] = 1 + 2*a
+        ab[2, :-1] = -a
+        return ab
+
+    def _adi_steps(self, t_end):
+        """ Returns the list of adi time steps over t_end. They start at the
+            explicit time step and grow by ADI_GROWTH up to implicit_dt,
+            then the rest of t_end is split evenly.
+        """
+        steps = []
+        t = 0.0
+        dt = min(self.dt, self.implicit_dt)
+        while(dt < self.implicit_dt and t + dt < t_end):
+            steps.append(dt)
+            t += dt
+            dt *= ADI_GROWTH
+        n = max(int(math.ceil((t_end - t) / self.implicit_dt)), 1)
+        return steps + [(t_end - t) / n]*n
+
+    def _update_adi(self, t_end, sink, source):
+        """ Solves the system with Crank-Nicolson ADI steps (the Douglas
+            scheme): an explicit predictor with the full operator and the
+            sink/source terms, then one tridiagonal solve along each axis.
+            Unconditionally stable, but modes which are stiff along every
+            axis, like the ones point sources and masked voxels excite, are
+            not damped by long steps. The steps from _adi_steps start short
+            so those modes decay first, an hour still only takes about 20
+            steps. With Michaelis-Menten uptake the steps are backward Euler
+            steps of about implicit_dt solved by _solve_uptake instead.
+        """
+        epsilon = 1E-10
+        theta = 0.5
+        if(self.uptake == "michaelis_menten"):
+            #the uptake does not split along the axes, so take backward
+            #Euler steps solved with Newton-Krylov instead
+            steps = max(int(math.ceil(t_end / self.implicit_dt)), 1)
+            for step in range(0, steps):
+                self._solve_uptake(sink, source, t_end / float(steps))
+            return
+        #the change per second from the sinks and sources
+        rate = ((source - sink) / self._grid_vol).astype(self.dtype)
+        spacing = (self._dx, self._dy, self._dz)
+        C = np.array(self.Ci, dtype=self.dtype)
+        #the flux in from the constant outside concentration
+        zeros = np.zeros(C.shape, dtype=self.dtype)
+        for axis in range(0, 3):
+            rate = rate + self._axis_laplacian(zeros, axis,
+                                               self._c_out)*self._D
+        for dt in self._adi_steps(t_end):
+            #the diffusion along each axis at the start of the step, the
+            #outside concentration cancels out of the corrections
+            lap = [self._axis_laplacian(C, axis, 0.0)*(self._D*dt)
+                   for axis in range(0, 3)]
+            #predictor
+            V = C + lap[0] + lap[1] + lap[2] + rate*dt
+            #then correct implicitly along each axis
+            for axis in range(0, 3):
+                a = theta*self._D*dt / spacing[axis]**2
+                rhs = np.moveaxis(V - theta*lap[axis], axis, 0)
+                shp = rhs.shape
+                sol = solve_banded((1, 1), self._axis_matrix(axis, a),
+                                   rhs.reshape(shp[0], -1))
+                V = np.moveaxis(sol.reshape(shp), 0, axis)
+            #make sure its positive
+            V = V * (V > 0.0)
+            diff = np.sum(np.abs(C - V))
+            C = V
+            if(diff < epsilon):
+                break
+        self.C = np.ascontiguousarray(C)
+        self.Ci = self.C
+
+    def _stencil_buffers(self):
+        """ Returns the two padded ping-pong buffers and the scratch array
+            used by the explicit stencil. The one voxel halo of the buffers
+            holds the outside concentration.
+        """
+        if("stencil" not in self._cache):
+            shp = self.Ci.shape
+            padded = (shp[0] + 2, shp[1] + 2, shp[2] + 2)
+            self._cache["stencil"] = (
+                np.full(padded, self._c_out, dtype=self.dtype),
+                np.full(padded, self._c_out, dtype=self.dtype),
+                np.empty(shp, dtype=self.dtype))
+        return self._cache["stencil"]
+
+    def _active_box(self, sink, source, tol):
+        """ Returns the (lo, hi) voxel bounds of the region the explicit
+            stencil has to be solved in: every sink and source plus any
+            voxel more than tol away from the outside concentration, padded
+            by ACTIVE_MARGIN voxels. Returns None if there is no such voxel.
+        """
+        mask = (sink != 0) | (source != 0)
+        mask |= np.abs(self.Ci - self._c_out) > tol
+        if(not np.any(mask)):
+            return None
+        lo = []
+        hi = []
+        for axis in range(0, 3):
+            other = tuple(a for a in range(0, 3) if a != axis)
+            hit = np.nonzero(np.any(mask, axis=other))[0]
+            lo.append(max(hit[0] - ACTIVE_MARGIN, 0))
+            hi.append(min(hit[-1] + 1 + ACTIVE_MARGIN, mask.shape[axis]))
+        return lo, hi
+
+    def _grow_active_box(self, C, lo, hi, tol):
+        """ Grows the active box by ACTIVE_MARGIN voxels past every face
+            where the concentration in C (the box values) differs from the
+            outside concentration by more than tol
+            returns - True if the box changed
+        """
+        grown = False
+        for axis in range(0, 3):
+            Ct = np.moveaxis(C, axis, 0)
+            n = self.Ci.shape[axis]
+            if(lo[axis] > 0 and np.max(np.abs(Ct[0] - self._c_out)) > tol):
+                lo[axis] = max(lo[axis] - ACTIVE_MARGIN, 0)
+                grown = True
+            if(hi[axis] < n and np.max(np.abs(Ct[-1] - self._c_out)) > tol):
+                hi[axis] = min(hi[axis] + ACTIVE_MARGIN, n)
+                grown = True
+        return grown
+
+    def _update_explicit(self, t_end, sink, source):
         """ Solves the system over using the predetermined time step dt
-            until the end time of the simulation is reached.
+            until the end time of the simulation is reached. Each step is a
+            single fused 7-point stencil update between two preallocated
+            padded buffers, and the convergence is checked every
+            check_every steps. If active_region_tol is set the stencil only
+            runs inside a box around the sinks, sources and significant
+            concentrations, grown whenever its faces exceed the tolerance.
+            The voxels outside the box keep their values.
             t_end - the end time to solve the system towards
         """
         t = 0
         epsilon = 1E-10
         diff = epsilon  * 2
-        zeros = np.zeros(self.Ci.shape)
+        old, new, tmp = self._stencil_buffers()
+        inner = (slice(1, -1), slice(1, -1), slice(1, -1))
+        old[inner] = self.Ci
+        tol = self.active_region_tol
+        if(tol is None):
+            lo = [0, 0, 0]
+            hi = list(self.Ci.shape)
+        else:
+            box = self._active_box(sink, source, tol)
+            if(box is None):
+                #nothing to diffuse
+                self.C = np.array(self.Ci, dtype=self.dtype)
+                self.Ci = self.C
+                return
+            lo, hi = box
+            #both buffers hold the frozen values outside the box
+            new[inner] = self.Ci
+        #the stencil weights
+        cx = self._D*self.dt / self._dx**2
+        cy = self._D*self.dt / self._dy**2
+        cz = self._D*self.dt / self._dz**2
+        cc = 1.0 - 2.0*(cx + cy + cz)
+        rate, vmax = self._rates(self.dt, sink, source)
+        itrs = 0
         while(t <= t_end and diff >= epsilon):
-            #solve for the gradients in each direction
-            l_x = ndimage.convolve(self.Ci, self._lx, mode = "constant",
-                                   cval = self._c_out)
-            l_y = ndimage.convolve(self.Ci, self._ly, mode = "constant",
-                                   cval = self._c_out)
-            l_z = ndimage.convolve(self.Ci, self._lz, mode = "constant",
-                                   cval = self._c_out)
-            #first diffusion
-            self.C = self.Ci + (l_x + l_y + l_z)*self._D*self.dt
-            #MUST BE normalized by unit VOLUME
-            temp_sink = (-sink*self.dt) / self._grid_vol
-            temp_source = source*self.dt / self._grid_vol
-            self.C += temp_sink + temp_source
-            #get the summed difference
-            diff = np.sum(np.abs(self.Ci - self.C))
+            #the box in the padded buffers, shifted in each direction
+            bx = slice(lo[0] + 1, hi[0] + 1)
+            by = slice(lo[1] + 1, hi[1] + 1)
+            bz = slice(lo[2] + 1, hi[2] + 1)
+            box_tmp = tmp[:hi[0] - lo[0], :hi[1] - lo[1], :hi[2] - lo[2]]
+            C = new[bx, by, bz]
+            Ci = old[bx, by, bz]
+            np.multiply(Ci, cc, out=C)
+            #the neighbors in each direction
+            np.add(old[lo[0] + 2:hi[0] + 2, by, bz], old[lo[0]:hi[0], by, bz],
+                   out=box_tmp)
+            box_tmp *= cx
+            C += box_tmp
+            np.add(old[bx, lo[1] + 2:hi[1] + 2, bz], old[bx, lo[1]:hi[1], bz],
+                   out=box_tmp)
+            box_tmp *= cy
+            C += box_tmp
+            np.add(old[bx, by, lo[2] + 2:hi[2] + 2], old[bx, by, lo[2]:hi[2]],
+                   out=box_tmp)
+            box_tmp *= cz
+            C += box_tmp
+            C += rate[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+            if(vmax is not None):
+                #the uptake, linearized at the start of the step
+                np.add(Ci, self.km, out=box_tmp)
+                np.divide(vmax[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]],
+                          box_tmp, out=box_tmp)
+                box_tmp += 1.0
+                C /= box_tmp
+            itrs += 1
+            #the faces are checked every step since the values outside the
+            #box are held fixed until it grows
+            grown = tol is not None and self._grow_active_box(C, lo, hi, tol)
+            if(itrs % self.check_every == 0 and not grown):
+                #get the summed difference
+                np.subtract(Ci, C, out=box_tmp)
+                np.abs(box_tmp, out=box_tmp)
+                diff = np.sum(box_tmp)
             #make sure its positive
-            self.C = self.C * (self.C > 0.0)
+            np.maximum(C, 0.0, out=C)
             #update the old
-            self.Ci = self.C
+            old, new = new, old
             #update the time step
             t += self.dt
+        self.C = old[inner].copy()
+        self.Ci = self.C
 
     def __repr__(self):
         """ Returns a string representation of the gradient
@@ -244,5 +758,365 @@ class Gradient(object):
     #also make it hashable
     def __hash__(self):
         return hash(self.name)
+
+#-----------------------------------------------------------------------
+#class GradientSet - solves several gradients on the same grid together
+class GradientSet(object):
+    """ Stacks explicit gradients which share the same grid geometry in to
+        one (S, x, y, z) array and advances all the species with a single
+        4D stencil per time step, with a per species diffusion coefficient,
+        outside concentration, sink and source. Every species is stepped at
+        the smallest stable dt of the set.
+        gradients - the list of gradients to solve together
+        ERRORS - ValueError if any of the gradients is not accepted by
+                 accepts or they do not share the same grid
+    """
+
+    def __init__(self, gradients):
+        self.gradients = list(gradients)
+        if(len(self.gradients) == 0):
+            raise ValueError("A gradient set needs at least one gradient")
+        key = GradientSet.grid_key(self.gradients[0])
+        for gradient in self.gradients:
+            if(not GradientSet.accepts(gradient)):
+                raise ValueError("Gradient " + repr(gradient.name) +
+                                 " can not be solved in a set")
+            if(GradientSet.grid_key(gradient) != key):
+                raise ValueError("Gradient " + repr(gradient.name) +
+                                 " does not share the grid of the set")
+        g = self.gradients[0]
+        self.dt = min(gradient.dt for gradient in self.gradients)
+        self.check_every = min(gradient.check_every
+                               for gradient in self.gradients)
+        #per species values, shaped to broadcast over the grid
+        D = np.array([gradient._D for gradient in self.gradients])
+        self._cx = (D*self.dt / g._dx**2)[:, None, None, None]
+        self._cy = (D*self.dt / g._dy**2)[:, None, None, None]
+        self._cz = (D*self.dt / g._dz**2)[:, None, None, None]
+        self._cc = 1.0 - 2.0*(self._cx + self._cy + self._cz)
+        self._grid_vol = np.array([gradient._grid_vol
+                                   for gradient in self.gradients])
+        #solve in the widest type of the set
+        self.dtype = np.result_type(*[gradient.dtype
+                                      for gradient in self.gradients])
+        self._cx = self._cx.astype(self.dtype)
+        self._cy = self._cy.astype(self.dtype)
+        self._cz = self._cz.astype(self.dtype)
+        self._cc = self._cc.astype(self.dtype)
+        #the padded ping-pong buffers, the halo holds each outside value
+        S = len(self.gradients)
+        shp = g.shape()
+        padded = (S, shp[0] + 2, shp[1] + 2, shp[2] + 2)
+        c_out = np.array([gradient._c_out for gradient in self.gradients])
+        self._old = np.empty(padded, dtype=self.dtype)
+        self._old[:] = c_out[:, None, None, None]
+        self._new = self._old.copy()
+        self._tmp = np.empty((S,) + shp, dtype=self.dtype)
+
+    @staticmethod
+    def accepts(gradient):
+        """ Checks if a gradient can be solved as part of a set, it must be
+            an explicit gradient with linear uptake and no active region,
+            the set always updates the whole grid
+        """
+        return (gradient.batchable and gradient.solver == "explicit" and
+                gradient.uptake == "linear" and
+                gradient.active_region_tol is None)
+
+    @staticmethod
+    def grid_key(gradient):
+        """ Returns the key of the grid geometry of a gradient, gradients
+            with the same key can be solved in the same set
+        """
+        return (gradient.shape(), gradient._dx, gradient._dy, gradient._dz)
+
+    def __len__(self):
+        return len(self.gradients)
+
+    def update(self, t_end, sinks, sources):
+        """ Solves all the species in the set until the end time is reached
+            or none of them change any more.
+            t_end - the end time to solve the system towards
+            sinks, sources - the lists of sink and source arrays, one per
+                             gradient in the set
+        """
+        t = 0
+        epsilon = 1E-10
+        diff = epsilon * 2
+        old, new, tmp = self._old, self._new, self._tmp
+        inner = (slice(None), slice(1, -1), slice(1, -1), slice(1, -1))
+        for s in range(0, len(self.gradients)):
+            old[s][inner[1:]] = self.gradients[s].Ci
+        cx, cy, cz, cc = self._cx, self._cy, self._cz, self._cc
+        #MUST BE normalized by unit VOLUME
+        rate = np.empty(tmp.shape, dtype=self.dtype)
+        for s in range(0, len(self.gradients)):
+            rate[s] = (sources[s] - sinks[s])*self.dt / self._grid_vol[s]
+        itrs = 0
+        while(t <= t_end and diff >= epsilon):
+            C = new[inner]
+            Ci = old[inner]
+            np.multiply(Ci, cc, out=C)
+            #the neighbors in each direction
+            np.add(old[:, 2:, 1:-1, 1:-1], old[:, :-2, 1:-1, 1:-1], out=tmp)
+            tmp *= cx
+            C += tmp
+            np.add(old[:, 1:-1, 2:, 1:-1], old[:, 1:-1, :-2, 1:-1], out=tmp)
+            tmp *= cy
+            C += tmp
+            np.add(old[:, 1:-1, 1:-1, 2:], old[:, 1:-1, 1:-1, :-2], out=tmp)
+            tmp *= cz
+            C += tmp
+            C += rate
+            itrs += 1
+            if(itrs % self.check_every == 0):
+                #the largest summed difference of any species
+                np.subtract(Ci, C, out=tmp)
+                np.abs(tmp, out=tmp)
+                diff = np.max(np.sum(tmp.reshape(len(tmp), -1), axis=1))
+            #make sure its positive
+            np.maximum(C, 0.0, out=C)
+            #update the old
+            old, new = new, old
+            #update the time step
+            t += self.dt
+        self._old, self._new = old, new
+        for s in range(0, len(self.gradients)):
+            gradient = self.gradients[s]
+            gradient.C = old[s][inner[1:]].astype(gradient.dtype)
+            gradient.Ci = gradient.C
+            gradient._field_changed()
         
 
+#-----------------------------------------------------------------------
+#class NestedGradient - a fine gradient nested in a coarse gradient
+class NestedGradient(Gradient):
+    """ A two level gradient. The coarse level is a normal gradient over the
+        whole box, solved with any of the solvers. A fine level with refine
+        times the resolution covers a box of about fine_x, fine_y, fine_z
+        around the center, which follows the aggregate like the coarse grid.
+        The two levels are advanced together in steps of about nest_dt:
+        the sinks and sources are summed on to the coarse level, the coarse
+        level is solved, the fine level is solved with explicit steps
+        using the coarse field as its boundary, and the fine solution is
+        then averaged back on to the coarse voxels it covers.
+        The shape and object positions refer to the fine level, positions
+        past it are carried on to the coarse level, so objects outside
+        the fine level are summed in to and interpolated from the coarse
+        level.
+        fine_x, fine_y, fine_z - the spatial size of the fine level, rounded
+                                 up to an even number of coarse voxels
+        refine - the number of fine voxels along each coarse voxel edge
+        nest_dt - the time (sec) between exchanges of the two levels
+        ERRORS - ValueError if the fine level does not fit inside the
+                 coarse level
+    """
+
+    batchable = False
+
+    def __init__(self, name, D, x, y, z, dx, dy, dz, fine_x, fine_y, fine_z,
+                 outside_c = 0.0, vol_units = 1e-6,
+                 solver = "explicit", implicit_dt = 600.0, check_every = 10,
+                 dtype = np.float32, uptake = "linear", km = 0.0,
+                 interp_order = 5, refine = 3, nest_dt = 600.0):
+        Gradient.__init__(self, name, D, x, y, z, dx, dy, dz,
+                          outside_c = outside_c, vol_units = vol_units,
+                          solver = solver, implicit_dt = implicit_dt,
+                          check_every = check_every, dtype = dtype,
+                          uptake = uptake, km = km,
+                          interp_order = interp_order)
+        self.refine = max(int(refine), 1)
+        self.nest_dt = float(nest_dt)
+        #the number of coarse voxels under the fine level, keep it even so
+        #the centers of the two levels line up
+        spacing = (self._dx, self._dy, self._dz)
+        sizes = (fine_x, fine_y, fine_z)
+        self._nest_dims = []
+        self._nest_start = []
+        for axis in range(0, 3):
+            m = 2*int(math.ceil(sizes[axis] / (2.0*spacing[axis])))
+            n = self.Ci.shape[axis]
+            #keep at least one coarse voxel of boundary on each side
+            if(m < 2 or m > n - 2):
+                raise ValueError("The fine level of " + repr(name) +
+                                 " does not fit inside the coarse level")
+            self._nest_dims.append(m)
+            self._nest_start.append(int(n / 2) - m // 2)
+        #the fine level, padded by half a fine voxel so rounding cannot
+        #drop a voxel
+        h = [d / self.refine for d in spacing]
+        self.fine = Gradient(name, D,
+                             self._nest_dims[0]*self._dx + 0.5*h[0],
+                             self._nest_dims[1]*self._dy + 0.5*h[1],
+                             self._nest_dims[2]*self._dz + 0.5*h[2],
+                             h[0], h[1], h[2], outside_c = outside_c,
+                             vol_units = vol_units, check_every = check_every,
+                             dtype = dtype, uptake = uptake, km = km,
+                             interp_order = interp_order)
+
+    def _nest_box(self):
+        """ Returns the slices of the coarse voxels under the fine level
+        """
+        return tuple(slice(self._nest_start[a],
+                           self._nest_start[a] + self._nest_dims[a])
+                     for a in range(0, 3))
+
+    def _blocks(self, fine):
+        """ Returns a fine level array viewed as (m, r, m, r, m, r) blocks,
+            one (r, r, r) block per coarse voxel
+        """
+        r = self.refine
+        m = self._nest_dims
+        return fine.reshape(m[0], r, m[1], r, m[2], r)
+
+    def _restrict(self, fine):
+        """ Sums a fine level sink or source array on to the coarse level
+        """
+        coarse = np.zeros(self.Ci.shape)
+        coarse[self._nest_box()] = np.sum(self._blocks(fine), axis=(1, 3, 5))
+        return coarse
+
+    def _halo_points(self):
+        """ Returns the indices of the halo of the fine stencil buffers and
+            their positions in the coarse array as map_coordinates
+            coordinates
+        """
+        if("halo" not in self._cache):
+            shp = self.fine.shape()
+            mask = np.ones((shp[0] + 2, shp[1] + 2, shp[2] + 2), dtype=bool)
+            mask[1:-1, 1:-1, 1:-1] = False
+            idx = np.nonzero(mask)
+            #the center of padded fine voxel p in coarse voxel coordinates
+            coords = np.array([self._nest_start[a] +
+                               (idx[a] - 1 + 0.5) / self.refine - 0.5
+                               for a in range(0, 3)])
+            self._cache["halo"] = (idx, coords)
+        return self._cache["halo"]
+
+    def _set_fine_halo(self):
+        """ Sets the boundary of the fine level to the coarse field
+        """
+        idx, coords = self._halo_points()
+        values = ndimage.map_coordinates(self.C, coords, order=1,
+                                         mode="nearest")
+        old, new, tmp = self.fine._stencil_buffers()
+        old[idx] = values
+        new[idx] = values
+
+    def shape(self):
+        """ Returns the shape of the fine level
+        """
+        return self.fine.shape()
+
+    def _levels(self, array):
+        """ Splits an array from sum_at_grid_positions in to its (fine,
+            coarse) levels, an array shaped like the fine level only covers
+            the fine level
+        """
+        shp = self.fine.shape()
+        if(array.shape == shp):
+            return array, np.zeros(self.Ci.shape)
+        n = int(np.prod(shp))
+        return array[:n].reshape(shp), array[n:].reshape(self.Ci.shape)
+
+    def _in_fine(self, points):
+        """ Returns the (N,) bool array of which fine grid positions lie on
+            the fine level
+        """
+        return np.all((points >= 0) & (points < np.array(self.fine.shape())),
+                      axis=1)
+
+    def _to_coarse(self, points):
+        """ Converts (N,3) fine grid positions to coarse grid positions
+        """
+        return np.array(self._nest_start) + points / float(self.refine)
+
+    def set_initial_conditions(self, mask):
+        """ Sets the initial conditions of both levels from a mask from
+            sum_at_grid_positions, or one over the fine level alone. A
+            coarse voxel is masked if any fine voxel in it is.
+        """
+        fine, coarse = self._levels(mask)
+        self.fine.set_initial_conditions(fine)
+        Gradient.set_initial_conditions(self, (self._restrict(fine != 0) +
+                                               (coarse != 0)))
+
+    def get_object_position_on_grid(self, distance):
+        """ Returns the position of a distance vector from the center on
+            the fine level, which may lie past the fine level
+        """
+        return self.fine.get_object_position_on_grid(distance)
+
+    def sum_at_grid_positions(self, points, weights = None):
+        """ Sums values in to the voxels holding many fine grid positions,
+            on the fine level if they lie on it and the coarse level if not
+            points - (N,3) array of positions from get_object_position_on_grid
+            weights - the (N,) values to sum, or None to count the points
+            returns - the summed fine and coarse arrays, raveled and joined
+                      in to one array
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        inside = self._in_fine(points)
+        if(weights is None):
+            w_in = w_out = None
+        else:
+            weights = np.asarray(weights, dtype=float)
+            w_in = weights[inside]
+            w_out = weights[~inside]
+        fine = self.fine.sum_at_grid_positions(points[inside], w_in)
+        coarse = Gradient.sum_at_grid_positions(
+            self, self._to_coarse(points[~inside]), w_out)
+        return np.concatenate((fine.ravel(), coarse.ravel()))
+
+    def sample(self, points, outside = "clamp"):
+        """ Trilinear interpolation at many points at once, from the fine
+            level inside it and the coarse level elsewhere
+            points - (N,3) array of distance vectors from the center
+            outside - how points past the coarse level are handled, see
+                      Gradient.sample
+            returns - the (N,) array of values
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        values = Gradient.sample(self, points, outside)
+        inside = self._in_fine(self.fine.get_object_position_on_grid(points))
+        if(np.any(inside)):
+            values[inside] = self.fine.sample(points[inside])
+        return values
+
+    def interpolate_at_grid_positions(self, points):
+        """ Interpolates at many fine grid positions, from the fine level
+            if they lie on it and the coarse level if not
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        inside = self._in_fine(points)
+        values = np.zeros(len(points))
+        if(np.any(inside)):
+            values[inside] = self.fine.interpolate_at_grid_positions(
+                points[inside])
+        if(not np.all(inside)):
+            values[~inside] = Gradient.interpolate_at_grid_positions(
+                self, self._to_coarse(points[~inside]))
+        return values
+
+    def update(self, t_end, sink, source):
+        """ Solves both levels until the end time is reached
+            t_end - the end time to solve the system towards
+            sink, source - the sink and source arrays from
+                           sum_at_grid_positions, or arrays over the fine
+                           level alone
+        """
+        steps = max(int(math.ceil(t_end / self.nest_dt)), 1)
+        dt = t_end / float(steps)
+        sink, coarse_sink = self._levels(sink)
+        source, coarse_source = self._levels(source)
+        coarse_sink = self._restrict(sink) + coarse_sink
+        coarse_source = self._restrict(source) + coarse_source
+        box = self._nest_box()
+        for step in range(0, steps):
+            Gradient.update(self, dt, coarse_sink, coarse_source)
+            self._set_fine_halo()
+            self.fine.update(dt, sink, source)
+            #the fine solution replaces the coarse voxels under it
+            self.C[box] = np.mean(self._blocks(self.fine.C), axis=(1, 3, 5))
+            self.Ci = self.C
+        self._field_changed()
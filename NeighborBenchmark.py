@@ -0,0 +1,55 @@
+from simulationNeighbors import *
+import sys
+import time
+import numpy as np
+
+#times the neighbor engines on random spherical aggregates
+#runs from the command line and takes arguments in the follwing format
+#-0
+#-1 (optional) comma separated list of aggregate sizes
+#-2 (optional) number of repeats per timing
+
+def make_aggregate(n, radius):
+    """ Places n cells of the given radius uniformly in a sphere packed
+        at roughly the density of an aggregate
+    """
+    #volume fraction of about 0.6
+    big_r = radius * (n / 0.6)**(1./3.)
+    u = np.random.rand(n)**(1./3.) * big_r
+    v = np.random.normal(size=(n, 3))
+    v /= np.sqrt(np.sum(v*v, axis=1))[:, None]
+    return v * u[:, None]
+
+def time_engine(engine, points, lengths, repeats):
+    """ Returns the best time out of repeats calls of the engine
+    """
+    best = None
+    for i in range(0, repeats):
+        t = time.time()
+        engine(points, lengths)
+        t = time.time() - t
+        if(best is None or t < best):
+            best = t
+    return best
+
+if(__name__ == '__main__'):
+    args = sys.argv
+    sizes = [1000, 5000, 20000, 60000]
+    repeats = 3
+    if(len(args) > 1):
+        sizes = [int(s) for s in args[1].split(",")]
+    if(len(args) > 2):
+        repeats = int(args[2])
+    radius = 5.0
+    #the plain interaction length and one with a Verlet skin
+    for skin in (0.0, 4.0):
+        print("Skin: " + repr(skin))
+        print("N, pairs, kdtree (s), grid (s)")
+        for n in sizes:
+            points = make_aggregate(n, radius)
+            lengths = np.ones(n) * 2.0 * radius + skin
+            pairs = len(KDTreePairs(points, lengths)[0])
+            kd = time_engine(KDTreePairs, points, lengths, repeats)
+            grid = time_engine(GridPairs, points, lengths, repeats)
+            print(repr(n) + ", " + repr(pairs) + ", " + "%.4f" % kd +
+                  ", " + "%.4f" % grid)
@@ -208,8 +208,4 @@ class NueronalStemCell(SimulationObject):
                 if(r <= x):
                     self._division = True
                 
-    def get_interaction_length(self):
-        """ Gets the interaciton elngth for the cell. Overiides parent
-            Returns - the length of any interactions with this cell (float)
-        """
-        return self.radius + 2.0 #in um
+NueronalStemCell.register_interaction_type(length_offset = 2.0)
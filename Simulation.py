@@ -5,11 +5,15 @@
 ################################################################################
 import os, sys
 import platform
+from concurrent.futures import ThreadPoolExecutor
 import networkx as nx
 import numpy as np
 from simulationMath import *
 from simulationObjects import *
-from Gradient import Gradient
+from Gradient import Gradient, GradientSet
+from AgentStore import AgentStore, FixedConstraints
+from simulationMechanics import *
+from simulationNeighbors import *
 from scipy.spatial import *
 import pickle
 
@@ -191,13 +195,36 @@ class Simulation(object):
     """ A class for running simulations
     """
 
-    def __init__(self, name, path, start_time, end_time, time_step):
+    def __init__(self, name, path, start_time, end_time, time_step,
+                 collide_mode = "pairs", verlet_skin = None,
+                 neighbor_engine = "kdtree", active_set_tol = None,
+                 mechanics_workers = None, batch_gradients = False,
+                 gradient_workers = None):
         """ Initialization function for the simulation setup.
             name - the simulation name (string)
             path - the path to save the simulation information to (string)
             start_time - the start time for the simulation (float)
             end_time - the end time for the simulation (float)
             time_step - the time step to increment the simulation by (float)
+            collide_mode - "pairs" to find all interacting pairs in one
+                           query, or "ball" to query around each object
+            verlet_skin - if set, the skin distance (um) of a Verlet list
+                          used to reuse the pairs across time steps in
+                          the "pairs" collide mode
+            neighbor_engine - "kdtree" or "grid", the engine used to find
+                              the pairs in the "pairs" collide mode
+            active_set_tol - if set, optimize only relaxes the agents which
+                             moved more than this (um) in their last
+                             update, plus their neighbors
+            mechanics_workers - if set, the number of processes the full
+                                sweep spring pass in optimize is split over
+            batch_gradients - if True, explicit gradients which share the
+                              same grid are solved together as one
+                              GradientSet
+            gradient_workers - if set, the number of threads the gradient
+                               updates and interpolations are run on
+            ERRORS - ValueError if the collide mode or neighbor engine is
+                     not recognized
         """
         #set the base parameters
         #do some basic type checking
@@ -213,15 +240,44 @@ class Simulation(object):
         self.start_time = float(start_time)
         self.end_time = float(end_time)
         self.time_step = float(time_step)
+        if(collide_mode not in ("pairs", "ball")):
+            raise ValueError("Unknown collide mode " + repr(collide_mode))
+        self.collide_mode = collide_mode
+        if(neighbor_engine not in NEIGHBOR_ENGINES):
+            raise ValueError("Unknown neighbor engine " + repr(neighbor_engine))
+        self._neighbor_engine = NEIGHBOR_ENGINES[neighbor_engine]
+        if(verlet_skin is not None):
+            self._verlet = VerletList(verlet_skin, self._neighbor_engine)
+        else:
+            self._verlet = None
+        self.active_set_tol = active_set_tol
+        if(mechanics_workers is not None):
+            self._parallel = ParallelMechanics(mechanics_workers)
+        else:
+            self._parallel = None
 
-        #make a list to keep track of the sim objects
-        self.objects = []
+        #keep the mechanical state of the sim objects in an agent store
+        #the objects list is ordered by row in the store
+        self._agents = AgentStore()
+        self.objects = self._agents.objects
         #also the gradients
         self.gradients = []
         self._gradients_by_name = dict()
+        self.batch_gradients = batch_gradients
+        #the (indices, GradientSet) batches, rebuilt when gradients change
+        self._gradient_batches = None
+        self.gradient_workers = gradient_workers
+        #the thread pool for the gradients, started on the first update
+        self._gradient_pool = None
         #keep track of the fixed constraints
-        self._fixed_constraints = nx.Graph()
-        self.network = nx.Graph()
+        self._fixed_constraints = FixedConstraints()
+        #the interaction network, exported to networkx only when saving
+        self.network = CSRNetwork()
+        #the (i, j, dist, version) edge arrays from the last collide, if
+        #still valid, dist only holds while the agents' version matches
+        self._edges = None
+        #the (version, center, offsets) of the agents, see _get_center_offsets
+        self._center = None
         #add the add/remove buffers
         self._objects_to_remove = []
         self._objects_to_add = []
@@ -241,7 +297,11 @@ class Simulation(object):
         """ Adds the specified object to the list
         """
         if(isinstance(sim_object, SimulationObject)):
-            self.objects.append(sim_object)
+            self._agents.add(sim_object)
+            #the rows have changed
+            self._edges = None
+            if(self._verlet is not None):
+                self._verlet.invalidate()
             #also add it to the network
             self.network.add_node(sim_object)
             #increment the current ID
@@ -250,14 +310,17 @@ class Simulation(object):
     def remove(self, sim_object):
         """ Removes the specified object from the list
         """
-        self.objects.remove(sim_object)
+        #remove its fixed constraints while its row is still valid
+        self._fixed_constraints.remove_object(sim_object)
+        row, last = self._agents.remove(sim_object)
+        self._edges = None
+        if(self._verlet is not None):
+            self._verlet.invalidate()
+        if(row != last):
+            #the last object was moved in to the freed row
+            self._fixed_constraints.move_row(self.objects[row], last, row)
         #remove it from the network
         self.network.remove_node(sim_object)
-        #also remove it fomr the fixed network
-        try:
-            self._fixed_constraints.remove_node(sim_object)
-        except nx.NetworkXError:
-            pass
 
     def add_object_to_addition_queue(self, sim_object):
         """ Will add an object to the simulation object queue
@@ -282,23 +345,61 @@ class Simulation(object):
         if(isinstance(gradient, Gradient)):
             self.gradients.append(gradient)
             self._gradients_by_name[gradient.name] = gradient
+            self._gradient_batches = None
 
     def remove_gradient(self, gradient):
         """ Removes a gradient form the simulation
         """
         self.gradients.remove(gradient)
         del self._gradients_by_name[gradient.name]
+        self._gradient_batches = None
 
-    def add_fixed_constraint(self, obj1, obj2):
+    def _get_gradient_batches(self):
+        """ Groups the gradients in to the batches they are solved in
+            returns - a list of (indices, gradient_set) tuples where
+                      gradient_set is None for a gradient solved alone
+        """
+        if(self._gradient_batches is None):
+            groups = dict()
+            batches = []
+            for i in range(0, len(self.gradients)):
+                gradient = self.gradients[i]
+                if(self.batch_gradients and GradientSet.accepts(gradient)):
+                    key = GradientSet.grid_key(gradient)
+                    if(key not in groups):
+                        groups[key] = []
+                        batches.append(groups[key])
+                    groups[key].append(i)
+                else:
+                    batches.append([i])
+            self._gradient_batches = []
+            for indices in batches:
+                if(len(indices) > 1):
+                    gradient_set = GradientSet([self.gradients[i]
+                                                for i in indices])
+                else:
+                    gradient_set = None
+                self._gradient_batches.append((indices, gradient_set))
+        return self._gradient_batches
+
+    def add_fixed_constraint(self, obj1, obj2, length = None):
         """ Adds a fixed immutable constraint between two objects which is
             processed with the other optimization constraints
+            length - the rest length of the constraint, defaults to the
+                     sum of the object radii
+            ERRORS - ValueError if either object is not in the simulation
         """
-        self._fixed_constraints.add_edge(obj1, obj2)
+        if(obj1._store is not self._agents or obj2._store is not self._agents):
+            raise ValueError("Both objects must be added to the simulation")
+        if(length is None):
+            length = obj1.radius + obj2.radius
+        self._fixed_constraints.add(obj1, obj2, float(length))
 
     def remove_fixed_contraint(self, obj1, obj2):
         """ Removes a fixed immutable constraint between two objects
+            ERRORS - KeyError if the constraint does not exist
         """
-        self._fixed_constraints.remove_edge(obj1, obj2)
+        self._fixed_constraints.remove(obj1, obj2)
 
     def get_ID(self):
         """ Returns the current unique ID the simulation is on
@@ -349,6 +450,12 @@ class Simulation(object):
         #once the sim is done close the header file
         self._header.flush()
         self._header.close()
+        #stop any mechanics workers
+        if(self._parallel is not None):
+            self._parallel.close()
+        if(self._gradient_pool is not None):
+            self._gradient_pool.shutdown()
+            self._gradient_pool = None
 
     def update_object_queue(self):
         """ Updates the object add and remove queue
@@ -364,6 +471,26 @@ class Simulation(object):
         self._objects_to_add= []
         
 
+    def _update_gradient_batch(self, indices, gradient_set, sinks, sources):
+        """ Solves one batch of gradients for an hour and interpolates them
+            at the object locations. Batches only write to their own
+            gradients and gradient values, so they can run concurrently.
+        """
+        if(gradient_set is None):
+            i = indices[0]
+            self.gradients[i].update(60*60, sinks[i], sources[i])
+        else:
+            gradient_set.update(60*60, [sinks[i] for i in indices],
+                                [sources[i] for i in indices])
+        agents = self._agents
+        for i in indices:
+            gradient = self.gradients[i]
+            #the species columns were added by _define_sinks_and_sources,
+            #so the threads only write to their own columns
+            col = agents.species_column(gradient.name)
+            agents.value[:, col] = gradient.interpolate_at_grid_positions(
+                agents.grid_pos[:, col])
+
     def update(self):
         """ Updates all of the objects in the simulation
         """
@@ -373,9 +500,23 @@ class Simulation(object):
             sources, sinks = self._define_sinks_and_sources()
             #these are defined four an entire 1 hour time step
         #update the gradients
+        batches = self._get_gradient_batches()
+        if(self.gradient_workers is not None and len(batches) > 1):
+            if(self._gradient_pool is None):
+                self._gradient_pool = ThreadPoolExecutor(
+                    max_workers=max(int(self.gradient_workers), 1))
+            futures = [self._gradient_pool.submit(self._update_gradient_batch,
+                                                  indices, gradient_set,
+                                                  sinks, sources)
+                       for indices, gradient_set in batches]
+            #wait for all of them, re-raising any errors in order
+            for future in futures:
+                future.result()
+        else:
+            for indices, gradient_set in batches:
+                self._update_gradient_batch(indices, gradient_set,
+                                            sinks, sources)
         for i in range(0, len(self.gradients)):
-            self.gradients[i].update(60*60, sinks[i], sources[i])   
-            self.gradients[i].cubic_interpolate_at_object_locations(self.objects)
             print(self.gradients[i])
             print("Sources: " + repr(np.max(sources[i])) + " , " +repr(np.min(sources[i])))
             print("Sinks: " + repr(np.max(sinks[i])) + " , " + repr(np.min(sinks[i])))
@@ -394,18 +535,36 @@ class Simulation(object):
     def collide(self):
         """ Handles the collision map generation 
         """
-        #first make a list of points for the delaunay to use
-        points = np.zeros((len(self.objects), 3))
-        index_to_object = dict()
-        for i in range(0, len(self.objects)):
-            #Now we can add these points to the list
-            points[i] = self.objects[i].location
+        if(self.collide_mode == "ball"):
+            self._collide_ball()
+        else:
+            self._collide_pairs()
+
+    def _collide_pairs(self):
+        """ Finds every interacting pair with a single neighbor query and
+            keeps the deduplicated edge arrays for the mechanics pass
+        """
+        lengths = self._get_max_interaction_lengths()
+        if(self._verlet is not None):
+            i, j, dist = self._verlet.pairs(self._agents.location, lengths)
+        else:
+            i, j, dist = self._neighbor_engine(self._agents.location, lengths)
+        self._edges = (i, j, dist, self._agents.version)
+        #keep track of this as a network
+        self.network = CSRNetwork(self.objects, i, j)
+
+    def _collide_ball(self):
+        """ Handles the collision map generation by querying the neighbors
+            of each object one at a time
+        """
+        self._edges = None
+        #the positions are already stored contiguously
+        points = self._agents.location
         #now perform the nearest neghbor assessmentusing a KDTree
         tree = KDTree(points)
-        #keep track of this as a network
-        self.network = nx.Graph()
-        #add all the simobjects
-        self.network.add_nodes_from(self.objects)
+        #keep track of the edges as index pairs
+        first = []
+        second = []
         #add the edge if it is less than our interaction length
         for i in range(0, len(self.objects)):
             obj1 = self.objects[i]
@@ -413,11 +572,19 @@ class Simulation(object):
             indicies = tree.query_ball_point(points[i], dist)
             for j in range(0, len(indicies)):
                 ind = indicies[j]
-                obj2 = self.objects[ind]
-                #now add these to the edges
-                self.network.add_edge(obj1, obj2)
+                if(ind != i):
+                    first.append(min(i, ind))
+                    second.append(max(i, ind))
+        #most pairs are found from both ends, keep each one once
+        pairs = np.unique(np.array([first, second], dtype=np.intp).reshape(2, -1),
+                          axis=1)
+        #keep track of this as a network
+        self.network = CSRNetwork(self.objects, pairs[0], pairs[1])
 
     def optimize(self):                
+        if(self.active_set_tol is not None):
+            self._optimize_active_set()
+            return
         #apply constraints from each object and update the positions
         #keep track of the global col and opt vectors
         opt = 2
@@ -426,181 +593,251 @@ class Simulation(object):
         itrs = 0
         max_itrs = 10
         avg_error = 1.0 # um
+        #the network does not change while optimizing
+        spring_edges = self._get_spring_edges()
+        if(self._parallel is not None):
+            i, j, k, length = spring_edges[:4]
+            self._parallel.set_edges(self._agents.radius, length, i, j, k)
         while ((opt + col + fixed) >= avg_error and itrs < max_itrs):
             #reset these values
             opt = 0
             col = 0
             fixed = 0
             #handle the spring constraints
-            opt, col = self._handle_spring_constraints()
+            opt, col = self._handle_spring_constraints(spring_edges,
+                                                       self._parallel is not None)
+            #the positions are about to move so the collide distances
+            #are stale after the first iteration
+            spring_edges = spring_edges[:-1] + (None,)
             #handle to fixed constraints
             fixed = self._handle_fixed_constraints()
-            #now loop over and update all of the constraints
-            for i in range(0, len(self.objects)):
-                #update these collision and optimization vectors
-                #as well as any other constraints
-                self.objects[i].update_constraints(self.time_step)
+            #now update all of the constraints at once
+            self._agents.update_constraints()
             #increment the itrations
             itrs += 1
             #print the results
             print(itrs)
             print(opt, col, fixed)
 
+    def _optimize_active_set(self):
+        """ Relaxes the constraints only around the agents which have not
+            settled. Every iteration the agents whose last move was above
+            the tolerance and their neighbors are active, every edge touching
+            an active agent is evaluated and only the active agents move.
+            Uses the same stopping rule as optimize, with the errors of the
+            settled edges taken as zero.
+        """
+        opt = 2
+        col = 2
+        fixed = 2
+        max_itrs = 10
+        avg_error = 1.0 # um
+        tol = self.active_set_tol
+        agents = self._agents
+        i, j, k, length, n_edges, dist = self._get_spring_edges()
+        #map every agent to its edges so the active edges can be gathered
+        #without scanning all of them
+        indptr, incident = EdgeIncidence(len(agents), i, j)
+        fc = self._fixed_constraints
+        fi = fc.i
+        fj = fc.j
+        itrs = 0
+        while ((opt + col + fixed) >= avg_error and itrs < max_itrs):
+            hot = np.nonzero(agents.residual > tol)[0]
+            if(len(hot) == 0):
+                break
+            #add the neighbors of the unsettled agents
+            e = IncidentEdges(indptr, incident, hot)
+            active = np.unique(np.concatenate((hot, i[e], j[e])))
+            if(len(fi) > 0):
+                is_hot = np.zeros(len(agents), dtype=bool)
+                is_hot[hot] = True
+                f = is_hot[fi] | is_hot[fj]
+                active = np.unique(np.concatenate((active, fi[f], fj[f])))
+            #evaluate every edge touching an active agent
+            e = IncidentEdges(indptr, incident, active)
+            opt, col = SpringConstraints(agents.location, agents.radius,
+                                         length, i[e], j[e], k[e],
+                                         agents.disp, agents.fixed)
+            fixed = 0
+            if(len(fi) > 0):
+                is_active = np.zeros(len(agents), dtype=bool)
+                is_active[active] = True
+                f = is_active[fi] | is_active[fj]
+                fixed = FixedConstraintErrors(agents.location, fi[f], fj[f],
+                                              fc.rest[f], agents.fixed)
+                fixed = fixed / len(fi)
+            agents.update_constraints(active = active)
+            #average over all of the edges like optimize
+            opt = opt / max(n_edges*2.0, 1.0)
+            col = col / max(n_edges*2.0, 1.0)
+            itrs += 1
+            #print the results
+            print(itrs)
+            print(len(active), opt, col, fixed)
+
     def _set_gradient_inital_conditions(self):
         """ Defines the masks to specify the gradient intal conditions
         """
-        cent = self.get_center()
+        cent, offsets = self._get_center_offsets()
         for i in range(0, len(self.gradients)):
-            #make a mask the same size as the gradient
-            shp = self.gradients[i].shape()
-            print(shp)
-            mask = np.zeros(shp)
-            for j in range(0, len(self.objects)):
-                agent = self.objects[j]
-                #get the object position
-                pos = agent.location
-                #get the difference from the center
-                dist_vec = SubtractVec(pos, cent)
-                #convert this to a index value
-                #for all of the gradients get the coeffients
-                x, y, z = self.gradients[i].get_object_position_on_grid(dist_vec)
-                mask[x,y,z] = 1
+            print(self.gradients[i].shape())
+            #convert the agent offsets to index values, the mask is
+            #nonzero in every voxel holding an agent
+            pos = self.gradients[i].get_object_position_on_grid(offsets)
+            mask = self.gradients[i].sum_at_grid_positions(pos)
             #now pass this in to the set inital values function
             self.gradients[i].set_initial_conditions(mask)
 
-    def _handle_spring_constraints(self):
-        """
-        """
-        col = 0
-        opt = 0
-        edges = self.network.edges()
-        for i in range(0, len(self.network.edges())):
-            #for each edge optimize the spring interaction
-            edge = edges[i]
-            #get the objects
-            obj1 = edge[0]
-            obj2 = edge[1]
-            if(obj1.owner_ID != obj2.owner_ID):
-                #that is to say these are NOT internal constraints pciked up
-                #by the nearest neighbor approach
-                v12 = SubtractVec(obj2.location, obj1.location)
-                dist = Mag(v12)
-                #also compute the normal
-                norm = NormVec(v12)
-                #get the object radii
-                r_sum = obj1.radius + obj2.radius
-                #check for a collision
-                if(r_sum >= dist):
-                    #then apply the collision
-                    d = -norm*((r_sum-dist)/2.0)
-                    obj1.add_fixed_constraint_vec(d)
-                    obj2.add_fixed_constraint_vec(-d)
-                    #add this to the collision vec
-                    col += Mag(d)*2
-                #apply the spring
-                #also get the normal interaction length
-                l1 = obj1.get_interaction_length()
-                l2 = obj2.get_interaction_length()
-                #now figure out how far off the connection length  is
-                #from that distance
-                dist = dist - (l1 + l2)
-                #now get the spring constant strength
-                k1 = obj1.get_spring_constant(obj2)
-                k2 = obj2.get_spring_constant(obj1)
-                k = min(k1, k2)
-                #now we can apply the spring constraint to this
-                dist = (dist/2.0) * k
-                #make sure it has the correct direction
-                temp = ScaleVec(norm, dist)
-                #add these vectors to the object vectors
-                obj1.add_displacement_vec(temp)
-                obj2.add_displacement_vec(-temp)
-                #add to the global opt vec
-                opt += Mag(temp)
+    def _uses_interaction_table(self):
+        """ Checks if every agent type can use the interaction table
+        """
+        return bool(np.all(interaction_table.uses_table[self._agents.type]))
+
+    def _get_max_interaction_lengths(self):
+        """ Returns the (N,) array of max interaction lengths
+        """
+        if(self._uses_interaction_table()):
+            return self._agents.radius * 2.0
+        return np.fromiter((obj.get_max_interaction_length()
+                            for obj in self.objects),
+                           dtype=float, count=len(self.objects))
+
+    def _get_spring_edges(self):
+        """ Converts the interaction network in to the index arrays used by
+            the batched spring pass. Internal edges between agents with the
+            same owner are dropped.
+            returns - a tuple of (i, j, k, length, n_edges, dist) where
+                      n_edges is the total number of network edges and dist
+                      are the edge lengths from collide (None if unknown)
+        """
+        dist = None
+        if(self._edges is not None):
+            #use the edge arrays from the last collide directly, the
+            #distances only while no agent has moved since
+            i, j, dist, version = self._edges
+            if(version != self._agents.version):
+                dist = None
+            n_edges = len(i)
+        else:
+            #map the network rows to the agent store rows
+            rows = self._agents.index_of(self.network.nodes())
+            i, j = self.network.edge_arrays()
+            i = rows[i]
+            j = rows[j]
+            n_edges = len(i)
+        #that is to say these are NOT internal constraints pciked up
+        #by the nearest neighbor approach
+        owners = np.array([obj.owner_ID for obj in self.objects])
+        if(len(i) > 0):
+            keep = owners[i] != owners[j]
+            i = i[keep]
+            j = j[keep]
+            if(dist is not None):
+                dist = dist[keep]
+        if(self._uses_interaction_table()):
+            #look the parameters up by type code
+            types = self._agents.type
+            length = self._agents.radius + interaction_table.offsets[types]
+            k = interaction_table.springs[types[i], types[j]]
+        else:
+            #get the interaction lengths once for every object
+            length = np.fromiter((obj.get_interaction_length()
+                                  for obj in self.objects),
+                                 dtype=float, count=len(self.objects))
+            #now get the spring constant strength
+            objects = self.objects
+            k = np.fromiter((min(objects[a].get_spring_constant(objects[b]),
+                                 objects[b].get_spring_constant(objects[a]))
+                             for a, b in zip(i, j)),
+                            dtype=float, count=len(i))
+        return i, j, k, length, n_edges, dist
+
+    def _handle_spring_constraints(self, spring_edges = None,
+                                   parallel = False):
+        """ Applies the spring and collision constraints for every edge of
+            the interaction network in one batched pass
+            spring_edges - the output of _get_spring_edges, rebuilt if None
+            parallel - run the pass on the mechanics workers, which must
+                       have been given the same edges with set_edges
+        """
+        if(spring_edges is None):
+            spring_edges = self._get_spring_edges()
+        i, j, k, length, n_edges, dist = spring_edges
+        if(n_edges == 0):
+            return 0, 0
+        agents = self._agents
+        if(parallel):
+            opt, col = self._parallel.spring_constraints(agents.location,
+                                                         agents.disp,
+                                                         agents.fixed)
+        else:
+            opt, col = SpringConstraints(agents.location, agents.radius,
+                                         length, i, j, k, agents.disp,
+                                         agents.fixed, dist = dist)
         #return the average opt and col values
-        opt = opt / (len(self.network.edges())*2.0)
-        col = col / (len(self.network.edges())*2.0)
+        opt = opt / (n_edges*2.0)
+        col = col / (n_edges*2.0)
         return opt, col
 
     def _handle_fixed_constraints(self):
-        """
-        """
-        error = 0
-        edges = self._fixed_constraints.edges()
-        for i in range(0, len(edges)):
-            #for each edge optimize the spring interaction
-            edge = edges[i]
-            #get the objects
-            obj1 = edge[0]
-            obj2 = edge[1]
-            dist_vec = SubtractVec(obj2.location, obj1.location)
-            dist = Mag(dist_vec)
-            #also compute the normal
-            norm = NormVec(dist_vec)
-            #get the object radii
-            r_sum = obj1.radius + obj2.radius
-            #then apply the collision
-            d = -norm*((r_sum-dist)/2.0)
-            obj1.add_fixed_constraint_vec(d)
-            obj2.add_fixed_constraint_vec(-d)
-            #add this to the collision vec
-            error += Mag(d)*2
+        """ Applies all of the fixed constraints in one batched pass
+            returns - the average constraint error
+        """
+        fc = self._fixed_constraints
+        if(len(fc) == 0):
+            return 0
+        error = FixedConstraintErrors(self._agents.location, fc.i, fc.j,
+                                      fc.rest, self._agents.fixed)
         #calculate the average error
-        try:
-            error = error / len(self._fixed_constraints.edges())
-        except ZeroDivisionError:
-            error = 0 
-        return error
+        return error / len(fc)
 
     def _define_sinks_and_sources(self):
         """ Defines the sinks and soruce terms from the simulation
             network by figuring out where each agent in the network lies
-            and defining the subsequent diffusion procedures.
+            and defining the subsequent diffusion procedures. All the agents
+            are mapped to voxels at once and their coefficients are summed
+            in to the arrays by the gradient.
             returns - a list of (sink, source) as a tuple for each gradeint
         """
-        #make a set of sink and source arrays which match
-        #the size of each gradient
         sources = []
         sinks = []
+        if(len(self.gradients) == 0):
+            return sources, sinks
+        #get the offset of every agent from the center of the network
+        cent, offsets = self._get_center_offsets()
+        agents = self._agents
         for i in range(0, len(self.gradients)):
-            shp = self.gradients[i].shape()
-            source = np.zeros(shp)
-            sink = np.zeros(shp)
-            sources.append(source)
-            sinks.append(sink)
-        #get the center of the network
-        cent = self.get_center()
-        #now loop over all of the agents in the simulation
-        for j in range(0, len(self.objects)):
-            agent = self.objects[j]
-            #get the object position
-            pos = agent.location
-            #get the difference from the center
-            dist_vec = SubtractVec(pos, cent)
-            #convert this to a index value
-            #for all of the gradients get the coeffients
-            for i in range(0, len(self.gradients)):
-                x, y, z = self.gradients[i].get_object_position_on_grid(dist_vec)
-                agent.set_gradient_location(self.gradients[i].name, (x,y,z))
-                #see if the object conatins a value for this gradient
-                src, snk = agent.get_gradient_source_sink_coeff(self.gradients[i].name)
-                sources[i][int(x),int(y),int(z)] += src
-                sinks[i][int(x),int(y),int(z)] += snk
-                
+            gradient = self.gradients[i]
+            col = agents.species_column(gradient.name)
+            pos = gradient.get_object_position_on_grid(offsets)
+            agents.grid_pos[:, col] = pos
+            #the coefficients of agents without any for this gradient are 0
+            sources.append(gradient.sum_at_grid_positions(
+                pos, agents.source[:, col]))
+            sinks.append(gradient.sum_at_grid_positions(
+                pos, agents.sink[:, col]))
         #and return the list
         return sources, sinks
-                    
+
     def get_center(self):
         """ Returns the center of the simulation
             return - point in the form of (x,y,z)
         """
-        cent = (0,0,0)
-        for i in range(0, len(self.objects)):            
-            cent = AddVec(self.objects[i].location, cent)
-        #then scale the vector
-        cent = ScaleVec(cent, 1.0/ len(self.objects))
-        #and return it
-        return cent
+        return self._get_center_offsets()[0].copy()
+
+    def _get_center_offsets(self):
+        """ Returns the center of the agents and the (N,3) array of their
+            offsets from it, cached until any agent moves
+            returns - a tuple of (center, offsets)
+        """
+        agents = self._agents
+        if(self._center is None or self._center[0] != agents.version):
+            location = agents.location
+            #scale the summed positions
+            cent = np.sum(location, axis=0) * (1.0 / len(location))
+            self._center = (agents.version, cent, location - cent)
+        return self._center[1], self._center[2]
     
     def _create_header_file(self):
         """ Creates a simulation header file which will save all the relevant
@@ -636,7 +873,7 @@ class Simulation(object):
         base_path = self.path + self.name + self._sep
         #First save the network files
         n_path = base_path + "network" + repr(self.time) + ".gpickle"
-        nx.write_gpickle(self.network, n_path)
+        nx.write_gpickle(self.network.to_networkx(), n_path)
         #now write that path to the file
         self._header.write("," + n_path)
         #Then save the gradient files
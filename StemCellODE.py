@@ -366,8 +366,4 @@ class StemCell(SimulationObject):
 ####                    self.state = "T"
                 
 
-    def get_interaction_length(self):
-        """ Gets the interaciton elngth for the cell. Overiides parent
-            Returns - the length of any interactions with this cell (float)
-        """
-        return self.radius + 2.0 #in um
+StemCell.register_interaction_type(length_offset = 2.0)
@@ -0,0 +1,265 @@
+import numpy as np
+import multiprocessing as mp
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    #requires python 3.8 or later
+    shared_memory = None
+
+#how the mechanics workers are started. Never fork, the simulation may
+#already be running the gradient threads and forking a threaded process
+#can deadlock. The workers only need the shared memory names.
+if("forkserver" in mp.get_all_start_methods()):
+    _START_METHOD = "forkserver"
+else:
+    _START_METHOD = "spawn"
+
+def ScatterAddVec(target, index, vecs, sign = 1.0):
+    """ Adds the rows of vecs (M,3) in to the rows of target (N,3) given by
+        index (M,). Repeated indices accumulate.
+    """
+    n = target.shape[0]
+    for c in range(0, 3):
+        target[:, c] += sign * np.bincount(index, weights=vecs[:, c],
+                                           minlength=n)
+
+def EdgeIncidence(n, i, j):
+    """ Builds a CSR map from every node to the edges (i, j) touching it
+        n - the number of nodes
+        Returns - a tuple of (indptr, edges) where the edges of node a are
+                  edges[indptr[a]:indptr[a+1]]
+    """
+    ends = np.concatenate((i, j))
+    order = np.argsort(ends, kind="mergesort")
+    edges = np.concatenate((np.arange(len(i)), np.arange(len(j))))[order]
+    indptr = np.zeros(n + 1, dtype=np.intp)
+    indptr[1:] = np.cumsum(np.bincount(ends, minlength=n))
+    return indptr, edges
+
+def IncidentEdges(indptr, edges, nodes):
+    """ Returns the sorted unique ids of the edges touching any of the nodes
+    """
+    start = indptr[nodes]
+    count = indptr[nodes + 1] - start
+    total = np.sum(count)
+    if(total == 0):
+        return np.zeros(0, dtype=np.intp)
+    idx = np.repeat(start - np.cumsum(count) + count, count) + np.arange(total)
+    return np.unique(edges[idx])
+
+def EdgeVectors(location, i, j, dist = None):
+    """ Computes the separation of every edge (i, j) at once. The edge
+        lengths are reused if they are already known.
+        Returns - a tuple of (dist, norm) where dist is the (M,) array of
+                  lengths and norm is the (M,3) array of unit vectors
+                  pointing from i to j (zero for coincident points)
+    """
+    v12 = location[j] - location[i]
+    if(dist is None):
+        dist = np.sqrt(np.einsum("ij,ij->i", v12, v12))
+    norm = np.zeros(v12.shape)
+    nz = dist > 0
+    norm[nz] = v12[nz] / dist[nz, None]
+    return dist, norm
+
+def SpringConstraints(location, radius, length, i, j, k, disp, fixed,
+                      dist = None):
+    """ Batched version of the per edge spring and collision pass. For all
+        the edges (i, j) at once, resolves overlaps in to the fixed
+        accumulator and pulls the pair towards the sum of the interaction
+        lengths in to the disp accumulator.
+        location - (N,3) agent positions
+        radius - (N,) agent radii
+        length - (N,) agent interaction lengths
+        i, j - (M,) int arrays of edge end points
+        k - (M,) or scalar spring constants for each edge
+        disp, fixed - (N,3) accumulators, updated in place
+        dist - (M,) edge lengths if already known for these positions
+        Returns - a tuple of the summed (opt, col) magnitudes
+    """
+    if(len(i) == 0):
+        return 0.0, 0.0
+    dist, norm = EdgeVectors(location, i, j, dist)
+    #handle the collisions
+    overlap = radius[i] + radius[j] - dist
+    hit = overlap >= 0
+    d = -norm[hit] * (overlap[hit] / 2.0)[:, None]
+    ScatterAddVec(fixed, i[hit], d)
+    ScatterAddVec(fixed, j[hit], d, sign = -1.0)
+    col = np.sum(overlap[hit] * (dist[hit] > 0))
+    #now the springs
+    stretch = ((dist - (length[i] + length[j])) / 2.0) * k
+    temp = norm * stretch[:, None]
+    ScatterAddVec(disp, i, temp)
+    ScatterAddVec(disp, j, temp, sign = -1.0)
+    opt = np.sum(np.abs(stretch) * (dist > 0))
+    return opt, col
+
+def FixedConstraintErrors(location, i, j, rest, fixed):
+    """ Batched fixed constraint pass. Pushes every constrained pair (i, j)
+        towards its rest length through the fixed accumulator.
+        location - (N,3) agent positions
+        i, j - (M,) int arrays of constrained rows
+        rest - (M,) array of rest lengths
+        fixed - (N,3) accumulator, updated in place
+        Returns - the summed error magnitude
+    """
+    if(len(i) == 0):
+        return 0.0
+    dist, norm = EdgeVectors(location, i, j)
+    err = rest - dist
+    d = -norm * (err / 2.0)[:, None]
+    ScatterAddVec(fixed, i, d)
+    ScatterAddVec(fixed, j, d, sign = -1.0)
+    return np.sum(np.abs(err) * (dist > 0))
+
+#-----------------------------------------------------------------------
+#shared memory helpers for the parallel mechanics backend
+
+#the shared memory blocks a worker process has attached to, by name
+_attached = dict()
+
+def _shared_array(names, key, shape, dtype = np.float64):
+    """ Returns an array over the named shared memory block, attaching the
+        calling process to it on first use
+    """
+    name = names[key]
+    if(name not in _attached):
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=_attached[name].buf)
+
+def _spring_worker(task):
+    """ Runs the spring pass over one partition of the edges and writes the
+        partial displacement sums in to the worker's accumulator slot
+        task - a tuple of (names, n_cap, m_cap, n_slots, slot, n, lo, hi)
+        Returns - a tuple of the summed (opt, col) magnitudes
+    """
+    names, n_cap, m_cap, n_slots, slot, n, lo, hi = task
+    location = _shared_array(names, "location", (n_cap, 3))[:n]
+    radius = _shared_array(names, "radius", (n_cap,))[:n]
+    length = _shared_array(names, "length", (n_cap,))[:n]
+    i = _shared_array(names, "i", (m_cap,), np.intp)[lo:hi]
+    j = _shared_array(names, "j", (m_cap,), np.intp)[lo:hi]
+    k = _shared_array(names, "k", (m_cap,))[lo:hi]
+    disp = _shared_array(names, "disp", (n_slots, n_cap, 3))[slot, :n]
+    fixed = _shared_array(names, "fixed", (n_slots, n_cap, 3))[slot, :n]
+    disp[:] = 0
+    fixed[:] = 0
+    return SpringConstraints(location, radius, length, i, j, k, disp, fixed)
+
+#-----------------------------------------------------------------------
+#class ParallelMechanics - spring pass spread over a pool of processes
+class ParallelMechanics(object):
+    """ Runs the batched spring pass on a pool of worker processes. The
+        positions, agent parameters, edges and one set of accumulators per
+        worker live in shared memory. The edges are split in to one
+        contiguous partition per worker and the partial displacement sums
+        are reduced after every pass, which gives the same Jacobi update as
+        SpringConstraints up to floating point rounding.
+        workers - the number of worker processes
+        ERRORS - ImportError if multiprocessing.shared_memory is unavailable
+    """
+
+    def __init__(self, workers):
+        if(shared_memory is None):
+            raise ImportError("ParallelMechanics requires multiprocessing.shared_memory")
+        self.workers = max(int(workers), 1)
+        self._pool = None
+        self._blocks = dict()
+        self._names = dict()
+        self._n_cap = 0
+        self._m_cap = 0
+        self.n = 0
+        self.m = 0
+
+    def _allocate(self, key, shape, dtype = np.float64):
+        """ (Re)creates the named shared memory block with the given shape
+        """
+        if(key in self._blocks):
+            shm = self._blocks.pop(key)[0]
+            shm.close()
+            shm.unlink()
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        self._blocks[key] = (shm, arr)
+        self._names[key] = shm.name
+
+    def _array(self, key):
+        return self._blocks[key][1]
+
+    def set_edges(self, radius, length, i, j, k):
+        """ Copies the agent parameters and edges for the coming optimize
+            in to shared memory, growing the blocks if needed
+            radius, length - (N,) agent radii and interaction lengths
+            i, j, k - (M,) edge end points and spring constants
+        """
+        n = len(radius)
+        m = len(i)
+        grow = n > self._n_cap or m > self._m_cap
+        if(grow and self._pool is not None):
+            #restart the workers so they drop the old blocks
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if(n > self._n_cap):
+            self._n_cap = max(2 * n, 1024)
+            self._allocate("location", (self._n_cap, 3))
+            self._allocate("radius", (self._n_cap,))
+            self._allocate("length", (self._n_cap,))
+            self._allocate("disp", (self.workers, self._n_cap, 3))
+            self._allocate("fixed", (self.workers, self._n_cap, 3))
+        if(m > self._m_cap):
+            self._m_cap = max(2 * m, 1024)
+            self._allocate("i", (self._m_cap,), np.intp)
+            self._allocate("j", (self._m_cap,), np.intp)
+            self._allocate("k", (self._m_cap,))
+        self.n = n
+        self.m = m
+        self._array("radius")[:n] = radius
+        self._array("length")[:n] = length
+        self._array("i")[:m] = i
+        self._array("j")[:m] = j
+        self._array("k")[:m] = k
+        if(self._pool is None):
+            self._pool = mp.get_context(_START_METHOD).Pool(self.workers)
+
+    def spring_constraints(self, location, disp, fixed):
+        """ Parallel version of SpringConstraints over the edges given to
+            set_edges. Adds the reduced displacements in to disp and fixed.
+            Returns - a tuple of the summed (opt, col) magnitudes
+        """
+        n = self.n
+        self._array("location")[:n] = location
+        bounds = np.linspace(0, self.m, self.workers + 1).astype(int)
+        tasks = [(self._names, self._n_cap, self._m_cap, self.workers,
+                  w, n, bounds[w], bounds[w+1])
+                 for w in range(0, self.workers)]
+        results = self._pool.map(_spring_worker, tasks)
+        #reduce the partial sums
+        disp += np.sum(self._array("disp")[:, :n], axis=0)
+        fixed += np.sum(self._array("fixed")[:, :n], axis=0)
+        opt = sum(r[0] for r in results)
+        col = sum(r[1] for r in results)
+        return opt, col
+
+    def close(self):
+        """ Stops the worker pool and frees the shared memory
+        """
+        if(self._pool is not None):
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        for key in list(self._blocks.keys()):
+            shm = self._blocks.pop(key)[0]
+            shm.close()
+            shm.unlink()
+        self._names = dict()
+        self._n_cap = 0
+        self._m_cap = 0
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -0,0 +1,341 @@
+import numpy as np
+import networkx as nx
+from scipy.spatial import cKDTree
+
+def PairDistances(points, i, j):
+    """ Computes the distance between the points of every pair (i, j)
+        Returns - a (M,) array of distances
+    """
+    v = points[j] - points[i]
+    return np.sqrt(np.einsum("ij,ij->i", v, v))
+
+def KDTreePairs(points, lengths):
+    """ Finds every interacting pair of points in one KD-tree query. A pair
+        interacts if its distance is within the max interaction length of
+        either point, which is the same rule as querying a ball around
+        every point.
+        points - (N,3) array of positions
+        lengths - (N,) array of max interaction lengths
+        Returns - a tuple of (i, j, dist) arrays with i < j, no self pairs
+                  and no duplicates
+    """
+    if(len(points) < 2):
+        return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp),
+                np.zeros(0))
+    tree = cKDTree(points)
+    pairs = tree.query_pairs(np.max(lengths), output_type="ndarray")
+    i = pairs[:, 0].astype(np.intp)
+    j = pairs[:, 1].astype(np.intp)
+    dist = PairDistances(points, i, j)
+    keep = dist <= np.maximum(lengths[i], lengths[j])
+    return i[keep], j[keep], dist[keep]
+
+#the half shell of neighboring grid cells, each pair of cells is visited once
+_HALF_SHELL = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+               for dz in (-1, 0, 1) if (dx, dy, dz) > (0, 0, 0)]
+
+def GridPairs(points, lengths):
+    """ Finds every interacting pair of points by binning them in to a
+        uniform grid of cells as wide as the largest max interaction length
+        and only comparing points in the same or adjacent cells. Gives the
+        same pairs as KDTreePairs, but was slower than it at every size
+        NeighborBenchmark.py measured (about 1.3x at 20k-60k agents, more
+        with a Verlet skin), so it is not the default.
+        points - (N,3) array of positions
+        lengths - (N,) array of max interaction lengths
+        Returns - a tuple of (i, j, dist) arrays with i < j, no self pairs
+                  and no duplicates
+    """
+    n = len(points)
+    if(n < 2):
+        return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp),
+                np.zeros(0))
+    h = np.max(lengths)
+    #bin the points, leaving an empty layer of cells on every side
+    cells = np.floor((points - np.min(points, axis=0)) / h).astype(np.int64) + 1
+    dims = np.max(cells, axis=0) + 2
+    keys = cells[:, 0] + dims[0] * (cells[:, 1] + dims[1] * cells[:, 2])
+    #sort the points by cell
+    order = np.argsort(keys, kind="mergesort")
+    sorted_keys = keys[order]
+    cell_keys, starts, counts = np.unique(sorted_keys, return_index=True,
+                                          return_counts=True)
+    cell_of = np.searchsorted(cell_keys, sorted_keys)
+    #work on the sorted copies so the gathers stay local
+    sp = points[order]
+    sl = lengths[order]
+    pos = np.arange(n)
+    first = []
+    second = []
+    dists = []
+    def keep_pairs(a, b):
+        dist = PairDistances(sp, a, b)
+        keep = dist <= np.maximum(sl[a], sl[b])
+        first.append(a[keep])
+        second.append(b[keep])
+        dists.append(dist[keep])
+    #pairs within the same cell
+    reps = starts[cell_of] + counts[cell_of] - pos - 1
+    keep_pairs(np.repeat(pos, reps),
+               np.repeat(pos + 1 - np.cumsum(reps) + reps, reps) +
+               np.arange(np.sum(reps)))
+    #pairs with the neighboring cells
+    for dx, dy, dz in _HALF_SHELL:
+        nb_keys = sorted_keys + dx + dims[0] * (dy + dims[1] * dz)
+        found = np.searchsorted(cell_keys, nb_keys)
+        found = np.minimum(found, len(cell_keys) - 1)
+        hit = cell_keys[found] == nb_keys
+        reps = np.where(hit, counts[found], 0)
+        total = np.sum(reps)
+        if(total == 0):
+            continue
+        keep_pairs(np.repeat(pos, reps),
+                   np.repeat(starts[found] - np.cumsum(reps) + reps, reps) +
+                   np.arange(total))
+    i = order[np.concatenate(first)]
+    j = order[np.concatenate(second)]
+    return np.minimum(i, j), np.maximum(i, j), np.concatenate(dists)
+
+#the neighbor engines selectable by name
+NEIGHBOR_ENGINES = {"kdtree" : KDTreePairs, "grid" : GridPairs}
+
+#-----------------------------------------------------------------------
+#class VerletList - neighbor pairs reused across time steps
+class VerletList(object):
+    """ Keeps the candidate pairs within the max interaction length plus a
+        skin margin and reuses them until some point has moved more than
+        half the skin since the last build, or the points change.
+        skin - the extra margin around the interaction lengths (um)
+        engine - the function used to build the pairs, i.e. KDTreePairs
+    """
+
+    def __init__(self, skin, engine = KDTreePairs):
+        self.skin = float(skin)
+        self._engine = engine
+        #the number of times the candidate pairs were rebuilt
+        self.builds = 0
+        self.invalidate()
+
+    def invalidate(self):
+        """ Forces a rebuild on the next call to pairs, i.e. when points
+            are added or removed
+        """
+        self._i = None
+        self._j = None
+        self._ref = None
+        self._lengths = None
+
+    def _needs_rebuild(self, points, lengths):
+        """ Checks if the candidate pairs may be missing a pair
+        """
+        if(self._ref is None or len(self._ref) != len(points)):
+            return True
+        if(not np.array_equal(self._lengths, lengths)):
+            return True
+        #the displacement of every point since the last build
+        moved = points - self._ref
+        moved = np.einsum("ij,ij->i", moved, moved)
+        return np.max(moved) > (self.skin / 2.0)**2
+
+    def pairs(self, points, lengths):
+        """ Returns the interacting pairs of the points in the same form as
+            KDTreePairs, rebuilding the candidate pairs only if needed
+        """
+        if(len(points) < 2):
+            return self._engine(points, lengths)
+        if(self._needs_rebuild(points, lengths)):
+            self._i, self._j, dist = self._engine(points, lengths + self.skin)
+            self._ref = points.copy()
+            self._lengths = lengths.copy()
+            self.builds += 1
+        i = self._i
+        j = self._j
+        dist = PairDistances(points, i, j)
+        keep = dist <= np.maximum(lengths[i], lengths[j])
+        return i[keep], j[keep], dist[keep]
+
+#-----------------------------------------------------------------------
+#class CSRNetwork - compact adjacency of the simulation objects
+class CSRNetwork(object):
+    """ Undirected adjacency of the simulation objects kept as CSR arrays
+        (indptr/indices int32) so the neighbors of a node are an O(1)
+        slice. Supports the parts of the networkx Graph interface the
+        simulation uses, and exports to networkx only when asked to.
+        Changes are queued and the arrays are rebuilt on the next query.
+        objects - the nodes, in row order
+        i, j - optional int arrays of edges between rows of objects
+    """
+
+    def __init__(self, objects = None, i = None, j = None):
+        if(objects is None):
+            objects = []
+        self._objects = list(objects)
+        if(i is None):
+            i = np.zeros(0, dtype=np.intp)
+            j = np.zeros(0, dtype=np.intp)
+        self._i = np.asarray(i, dtype=np.intp)
+        self._j = np.asarray(j, dtype=np.intp)
+        #the queued changes
+        self._new_edges = []
+        self._removed = set()
+        #lazy map from object to row
+        self._rows = None
+        self._build()
+
+    def _build(self):
+        """ Builds the CSR arrays from the edge arrays
+        """
+        n = len(self._objects)
+        rows = np.concatenate((self._i, self._j))
+        cols = np.concatenate((self._j, self._i))
+        order = np.argsort(rows, kind="mergesort")
+        self.indices = cols[order].astype(np.int32)
+        self.indptr = np.zeros(n + 1, dtype=np.int32)
+        self.indptr[1:] = np.cumsum(np.bincount(rows, minlength=n))
+        self._dirty = False
+
+    def _refresh(self):
+        """ Applies the queued changes and rebuilds the arrays
+        """
+        if(not self._dirty):
+            return
+        i = self._i
+        j = self._j
+        if(len(self._new_edges) > 0):
+            new = np.array(self._new_edges, dtype=np.intp)
+            i = np.concatenate((i, new[:, 0]))
+            j = np.concatenate((j, new[:, 1]))
+            self._new_edges = []
+        if(len(self._removed) > 0):
+            keep = np.ones(len(self._objects), dtype=bool)
+            keep[list(self._removed)] = False
+            new_row = np.cumsum(keep) - 1
+            e = keep[i] & keep[j]
+            i = new_row[i[e]]
+            j = new_row[j[e]]
+            self._objects = [obj for obj, k in zip(self._objects, keep) if k]
+            self._removed = set()
+            self._rows = None
+        self._i = i
+        self._j = j
+        self._build()
+
+    def _row_of(self, obj):
+        """ Returns the row of the object, or -1 if it is not a node
+        """
+        #the rows normally match the agent store rows
+        row = getattr(obj, "_index", -1)
+        if(0 <= row < len(self._objects) and self._objects[row] is obj):
+            if(row not in self._removed):
+                return row
+        if(self._rows is None):
+            self._rows = dict()
+            for r in range(0, len(self._objects)):
+                self._rows[self._objects[r]] = r
+        row = self._rows.get(obj, -1)
+        if(row in self._removed):
+            return -1
+        return row
+
+    def has_node(self, obj):
+        return self._row_of(obj) >= 0
+
+    def __contains__(self, obj):
+        return self.has_node(obj)
+
+    def __len__(self):
+        return self.number_of_nodes()
+
+    def add_node(self, obj):
+        """ Adds an object as a node with no edges
+        """
+        if(self._row_of(obj) >= 0):
+            return
+        row = len(self._objects)
+        self._objects.append(obj)
+        if(self._rows is not None):
+            self._rows[obj] = row
+        self._dirty = True
+
+    def add_nodes_from(self, objects):
+        for obj in objects:
+            self.add_node(obj)
+
+    def add_edge(self, obj1, obj2):
+        """ Adds an edge between two objects, adding them as nodes if needed
+        """
+        self.add_node(obj1)
+        self.add_node(obj2)
+        self._new_edges.append((self._row_of(obj1), self._row_of(obj2)))
+        self._dirty = True
+
+    def remove_node(self, obj):
+        """ Removes an object and all of its edges
+            ERRORS - KeyError if the object is not a node
+        """
+        row = self._row_of(obj)
+        if(row < 0):
+            raise KeyError("The object is not in the network")
+        self._removed.add(row)
+        self._dirty = True
+
+    def number_of_nodes(self):
+        return len(self._objects) - len(self._removed)
+
+    def number_of_edges(self):
+        self._refresh()
+        return len(self._i)
+
+    def nodes(self):
+        """ Returns a list of the objects in row order
+        """
+        self._refresh()
+        return list(self._objects)
+
+    def edge_arrays(self):
+        """ Returns the edges as a tuple of (i, j) row index arrays
+        """
+        self._refresh()
+        return self._i, self._j
+
+    def edges(self):
+        """ Returns a list of the edges as (object, object) tuples
+        """
+        self._refresh()
+        objects = self._objects
+        return [(objects[a], objects[b]) for a, b in zip(self._i, self._j)]
+
+    def neighbor_rows(self, row):
+        """ Returns the rows adjacent to row as a slice of the indices
+        """
+        self._refresh()
+        return self.indices[self.indptr[row]:self.indptr[row + 1]]
+
+    def neighbors(self, obj):
+        """ Returns a list of the objects adjacent to obj
+            ERRORS - KeyError if the object is not a node
+        """
+        self._refresh()
+        row = self._row_of(obj)
+        if(row < 0):
+            raise KeyError("The object is not in the network")
+        objects = self._objects
+        return [objects[r] for r in self.neighbor_rows(row)]
+
+    def degree(self, obj):
+        """ Returns the number of objects adjacent to obj
+            ERRORS - KeyError if the object is not a node
+        """
+        self._refresh()
+        row = self._row_of(obj)
+        if(row < 0):
+            raise KeyError("The object is not in the network")
+        return int(self.indptr[row + 1] - self.indptr[row])
+
+    def to_networkx(self):
+        """ Exports the network as a networkx Graph of the objects
+        """
+        graph = nx.Graph()
+        graph.add_nodes_from(self.nodes())
+        graph.add_edges_from(self.edges())
+        return graph
@@ -6,10 +6,169 @@
 from simulationMath import *
 import random as rand
 import math as math
+import numpy as np
+
+def _store_property(field):
+    """ Builds a property which reads and writes the given field of the
+        object's row in its AgentStore. Objects which are not part of a
+        store (i.e. not yet added to a simulation) keep a local value.
+    """
+    local = "_" + field + "_local"
+    #writing a location moves the agent
+    moves = field == "location"
+    def fget(self):
+        if(self._store is not None):
+            return self._store._arrays[field][self._index]
+        return self.__dict__[local]
+    def fset(self, value):
+        if(self._store is not None):
+            self._store._arrays[field][self._index] = value
+            if(moves):
+                self._store.version += 1
+        else:
+            self.__dict__[local] = value
+    return property(fget, fset)
+
+def _function_of(cls, name):
+    """ Returns the plain function behind the method name of the class
+    """
+    method = getattr(cls, name)
+    return getattr(method, "__func__", method)
+
+#the methods which must not be overridden for a type to use the table
+_TABLE_METHODS = ("get_interaction_length", "get_max_interaction_length",
+                  "get_spring_constant")
+
+class InteractionTable(object):
+    """ Registry of the mechanical parameters of each SimulationObject
+        type, so the mechanics can look them up by integer type code over
+        whole edge arrays instead of calling methods per edge.
+        Each type has an interaction length offset (the interaction length
+        is radius + offset) and a spring constant towards every other type.
+        Types which are not registered take the parameters of their
+        nearest registered base class.
+    """
+
+    def __init__(self):
+        #maps a class to its type code
+        self._codes = dict()
+        self._classes = []
+        self._offsets = []
+        self._springs = []
+        self._overrides = []
+        self._uses_table = []
+        #whether each type was registered or takes its base's parameters
+        self._explicit = []
+        #the lookup tables
+        self.offsets = np.zeros(0)
+        self.springs = np.zeros((0, 0))
+        self.uses_table = np.zeros(0, dtype=bool)
+
+    def register(self, cls, length_offset = 0.0, spring_constant = 0.25,
+                 spring_constants = None):
+        """ Registers (or updates) the parameters of a type
+            cls - the SimulationObject subclass
+            length_offset - added to the radius to get the interaction length
+            spring_constant - the spring constant towards any other type
+            spring_constants - optional dict of class -> spring constant
+                               overriding spring_constant for those types
+            returns - the type code
+        """
+        if(spring_constants is None):
+            spring_constants = dict()
+        code = self._codes.get(cls, None)
+        if(code is None):
+            code = len(self._classes)
+            self._codes[cls] = code
+            self._classes.append(cls)
+            self._offsets.append(0.0)
+            self._springs.append(0.0)
+            self._overrides.append(dict())
+            self._uses_table.append(False)
+            self._explicit.append(True)
+        self._explicit[code] = True
+        self._offsets[code] = float(length_offset)
+        self._springs[code] = float(spring_constant)
+        self._overrides[code] = dict(spring_constants)
+        #types which override the mechanics methods fall back to them
+        self._uses_table[code] = all(_function_of(cls, name) is
+                                     _function_of(SimulationObject, name)
+                                     for name in _TABLE_METHODS)
+        self._rebuild()
+        return code
+
+    def _registered_base(self, cls):
+        """ Returns the code of the nearest registered base class of cls, or
+            None if it has none
+        """
+        for base in cls.__mro__[1:]:
+            code = self._codes.get(base, None)
+            if(code is not None and self._explicit[code]):
+                return code
+        return None
+
+    def _override(self, code, other_cls):
+        """ Returns the spring constant of a type towards other_cls, the
+            overrides also apply to subclasses of the types they name
+        """
+        overrides = self._overrides[code]
+        for base in other_cls.__mro__:
+            if(base in overrides):
+                return overrides[base]
+        return self._springs[code]
+
+    def _rebuild(self):
+        """ Rebuilds the lookup tables
+        """
+        n = len(self._classes)
+        #copy the parameters of the types which were not registered
+        for code in range(0, n):
+            if(not self._explicit[code]):
+                base = self._registered_base(self._classes[code])
+                if(base is not None):
+                    self._offsets[code] = self._offsets[base]
+                    self._springs[code] = self._springs[base]
+                    self._overrides[code] = self._overrides[base]
+        self.offsets = np.array(self._offsets)
+        k = np.zeros((n, n))
+        for a in range(0, n):
+            for b in range(0, n):
+                k[a, b] = self._override(a, self._classes[b])
+        #the weaker of the two springs is used for each pair
+        self.springs = np.minimum(k, k.T)
+        self.uses_table = np.array(self._uses_table, dtype=bool)
+
+    def code_of(self, cls):
+        """ Returns the type code of a class. A class which is not yet known
+            is added with the parameters of its nearest registered base
+            class, or the default parameters if it has none.
+        """
+        code = self._codes.get(cls, None)
+        if(code is None):
+            code = self.register(cls)
+            self._explicit[code] = False
+            self._rebuild()
+        return code
+
+    def length_offset(self, cls):
+        return self._offsets[self.code_of(cls)]
+
+    def spring_constant(self, cls, other_cls):
+        """ Returns the spring constant of type cls towards type other_cls
+        """
+        return self._override(self.code_of(cls), other_cls)
+
+#the interaction parameters of all the simulation object types
+interaction_table = InteractionTable()
 
 class SimulationObject(object):
     """ Base class from which all simulation obejcts must inherit
     """
+    #the mechanical state lives in the simulation's AgentStore
+    location = _store_property("location")
+    radius = _store_property("radius")
+    _disp_vec = _store_property("disp")
+    _fixed_contraint_vec = _store_property("fixed")
 
     def __init__(self, location, radius, ID, owner_ID, sim_type):
         """ Base class which defines properties all sim objects MUST have
@@ -22,16 +181,19 @@ class SimulationObject(object):
                        i.e. this is the mechanism for multi-agent agents
             sim_type - the type of object the simulation object is
         """
-        self.location = location
-        self.radius = radius
+        #not attached to a store until added to a simulation
+        self._store = None
+        self._index = -1
+        self.location = np.array(location, dtype=float)
+        self.radius = float(radius)
         self.sim_type = sim_type
         self.ID = ID
         self.owner_ID = owner_ID
         #keep track of the opt and col vecs
-        self._disp_vec = [0,0,0]
-        self._fixed_contraint_vec = [0,0,0]
-        self._v = [0,0,0]
+        self._disp_vec = np.zeros(3)
+        self._fixed_contraint_vec = np.zeros(3)
         #keep track of production consumptions values
+        #(these dicts are only used while the object is not in a store)
         self.gradient_source_sink_coeff = dict()
         #keep track of the relative indices in the gradient array
         self.gradient_position = dict()
@@ -43,6 +205,35 @@ class SimulationObject(object):
         """
         pass
 
+    def _attach(self, store, index):
+        """ Makes the object a view over row index of the AgentStore store
+        """
+        self._store = store
+        self._index = index
+        #the gradient data now lives in the store
+        store.load_species(index, self.gradient_source_sink_coeff,
+                           self.gradient_position, self.gradient_value)
+        self.gradient_source_sink_coeff = dict()
+        self.gradient_position = dict()
+        self.gradient_value = dict()
+
+    def _detach(self):
+        """ Copies the object's row out of its store and makes the values
+            local to the object again
+        """
+        if(self._store is None):
+            return
+        arrays = self._store._arrays
+        row = self._index
+        (self.gradient_source_sink_coeff, self.gradient_position,
+         self.gradient_value) = self._store.species_dicts(row)
+        self._store = None
+        self._index = -1
+        self.location = arrays["location"][row].copy()
+        self.radius = float(arrays["radius"][row])
+        self._disp_vec = arrays["disp"][row].copy()
+        self._fixed_contraint_vec = arrays["fixed"][row].copy()
+
 
     def get_max_interaction_length(self):
         """ Get the max interaction length of the object
@@ -50,30 +241,55 @@ class SimulationObject(object):
         return self.radius*2.0 #in um
 
     def get_interaction_length(self):
-        return self.radius #in um
+        """ Gets the interaction length of the object, the radius plus the
+            length offset registered for its type
+        """
+        return self.radius + interaction_table.length_offset(type(self)) #in um
 
     def get_spring_constant(self, other):
         """ Gets the spring constant of the object
-            Returns: 1.0 by default
-            NOTE: Meant to be overwritten by a base class if more
-                  functionality is required
+            Returns: the constant registered for this type towards the type
+                     of other, 0.25 by default
+            NOTE: Prefer registering the type with
+                  register_interaction_type over overriding this, so the
+                  mechanics can use the vectorized table
+        """
+        return interaction_table.spring_constant(type(self), type(other))
+
+    @classmethod
+    def register_interaction_type(cls, length_offset = 0.0,
+                                  spring_constant = 0.25,
+                                  spring_constants = None):
+        """ Registers the mechanical parameters of this type in the
+            interaction table, see InteractionTable.register
+        """
+        return interaction_table.register(cls, length_offset,
+                                          spring_constant, spring_constants)
+
+    def _interaction_code(self):
+        """ Returns the type code of the object in the interaction table
         """
-        return 0.25
+        return interaction_table.code_of(type(self))
 
     def add_displacement_vec(self, vec):
         """ Adds a vector to the optimization vector
         """
-        self._disp_vec = AddVec(self._disp_vec, vec)
+        self._disp_vec += vec
 
     def add_fixed_constraint_vec(self, vec):
         """ Adds a vector to the optimization vector
         """
-        self._fixed_contraint_vec = AddVec(self._fixed_contraint_vec, vec)
+        self._fixed_contraint_vec += vec
 
     def set_gradient_source_sink_coeff(self, name, source, sink):
         """ Adds a production/consumption terms to the dicationary based on
             the gradient name
         """
+        if(self._store is not None):
+            col = self._store.species_column(name)
+            self._store._arrays["source"][self._index, col] = source
+            self._store._arrays["sink"][self._index, col] = sink
+            return
         #overwrite exsisting data
         self.gradient_source_sink_coeff[name] = (source, sink)
 
@@ -82,8 +298,15 @@ class SimulationObject(object):
             returns - a tuple of the (source, sink) values. If these are not
                       in the dictionary, returns (0,0)
         """
+        if(self._store is not None):
+            col = self._store.species.get(name, None)
+            if(col is None):
+                return (0,0)
+            arrays = self._store._arrays
+            return (arrays["source"][self._index, col],
+                    arrays["sink"][self._index, col])
         #returns the gradient values for the source and sink
-        if(name in self.gradient_source_sink_coeff.keys()):
+        if(name in self.gradient_source_sink_coeff):
             #name is in the dictionary
             return self.gradient_source_sink_coeff[name]
         else:
@@ -94,13 +317,25 @@ class SimulationObject(object):
         """ Adds the location of the agent on the grid for the gradient
             whose name is specified by name
         """
+        if(self._store is not None):
+            col = self._store.species_column(name)
+            self._store._arrays["grid_pos"][self._index, col] = location
+            return
         self.gradient_position[name] = location
 
     def get_gradient_location(self, name):
         """ Return the location of the agent on the grid for the gradient
             specified by the name, name
         """
-        if(name in self.gradient_position.keys()):
+        if(self._store is not None):
+            col = self._store.species.get(name, None)
+            if(col is None):
+                return None
+            pos = self._store._arrays["grid_pos"][self._index, col]
+            if(np.any(np.isnan(pos))):
+                return None
+            return pos
+        if(name in self.gradient_position):
             #name is in the dictionary
             return self.gradient_position[name]
         else:
@@ -110,12 +345,21 @@ class SimulationObject(object):
     def set_gradient_value(self, name, value):
         """ Adds the value of the gradient at this agent
         """
+        if(self._store is not None):
+            col = self._store.species_column(name)
+            self._store._arrays["value"][self._index, col] = value
+            return
         self.gradient_value[name] = value
 
     def get_gradient_value(self, name):
         """ Return the value fo the gradient at this agent
         """
-        if(name in self.gradient_value.keys()):
+        if(self._store is not None):
+            col = self._store.species.get(name, None)
+            if(col is None):
+                return -1
+            return self._store._arrays["value"][self._index, col]
+        if(name in self.gradient_value):
             #name is in the dictionary
             return self.gradient_value[name]
         else:
@@ -133,16 +377,52 @@ class SimulationObject(object):
             self._disp_vec = ScaleVec(n, 5.0)
         self.location = AddVec(self.location, self._disp_vec)
         #then clear it
-        self._disp_vec = [0,0,0]
+        self._disp_vec = np.zeros(3)
         
         #then update the the pos using the fixed vectors
         mag = Mag(self._fixed_contraint_vec)
         if(mag > 5):
-            n = NormVec(self._disp_vec)
+            n = NormVec(self._fixed_contraint_vec)
             self._fixed_contraint_vec = ScaleVec(n, 5.0)
         self.location = AddVec(self.location, self._fixed_contraint_vec)
         #htne clear it
-        self._fixed_contraint_vec = [0,0,0]
+        self._fixed_contraint_vec = np.zeros(3)
+
+    def __getstate__(self):
+        """ Pickles the object with its store values copied locally so
+            saved networks do not drag the whole store along
+        """
+        state = self.__dict__.copy()
+        if(self._store is not None):
+            arrays = self._store._arrays
+            row = self._index
+            state["_location_local"] = arrays["location"][row].copy()
+            state["_radius_local"] = float(arrays["radius"][row])
+            state["_disp_local"] = arrays["disp"][row].copy()
+            state["_fixed_local"] = arrays["fixed"][row].copy()
+            (state["gradient_source_sink_coeff"], state["gradient_position"],
+             state["gradient_value"]) = self._store.species_dicts(row)
+        state["_store"] = None
+        state["_index"] = -1
+        return state
+
+    def __setstate__(self, state):
+        """ Restores a pickled object. Also handles objects saved before
+            the AgentStore where the values were plain attributes
+        """
+        legacy = {"location" : "_location_local",
+                  "radius" : "_radius_local",
+                  "_disp_vec" : "_disp_local",
+                  "_fixed_contraint_vec" : "_fixed_local"}
+        for key in legacy.keys():
+            if(key in state):
+                state[legacy[key]] = state.pop(key)
+        state.pop("_v", None)
+        state.setdefault("_store", None)
+        state.setdefault("_index", -1)
+        state.setdefault("_disp_local", np.zeros(3))
+        state.setdefault("_fixed_local", np.zeros(3))
+        self.__dict__.update(state)
         
     def __repr__(self):
         """ Returns a string representation of the object
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from Gradient import Gradient, NestedGradient
+
+#the error single precision solves are allowed against double, relative
+#to the largest concentration
+FLOAT32_TOL = 1e-5
+
+def make_gradient(solver, dtype):
+    """ Returns a small gradient with a masked initial condition
+    """
+    g = Gradient("LIF", 10.0, 300.0, 300.0, 300.0, 15, 15, 15,
+                 outside_c = 0.5, solver = solver, dtype = dtype)
+    mask = np.zeros(g.shape())
+    mask[8:12, 8:12, 8:12] = 1
+    g.set_initial_conditions(mask)
+    return g
+
+def sinks_and_sources(shp):
+    """ Returns a sink and source array with overlapping blocks
+    """
+    sink = np.zeros(shp)
+    source = np.zeros(shp)
+    source[6:10, 6:10, 6:10] = 1e-18
+    sink[9:13, 8:11, 7:12] = 1.5e-18
+    return sink, source
+
+@pytest.mark.parametrize("solver", ["explicit", "adi", "steady", "spectral"])
+def test_float32_matches_float64(solver):
+    """ The single precision solves stay within FLOAT32_TOL of double
+        precision
+    """
+    C = dict()
+    for dtype in (np.float64, np.float32):
+        g = make_gradient(solver, dtype)
+        sink, source = sinks_and_sources(g.shape())
+        g.update(3600, sink, source)
+        assert g.C.dtype == np.dtype(dtype)
+        C[dtype] = np.asarray(g.C, dtype=float)
+    scale = np.abs(C[np.float64]).max()
+    assert np.abs(C[np.float32] - C[np.float64]).max() <= FLOAT32_TOL*scale
+
+def test_adi_matches_spectral():
+    """ With the default implicit_dt an hour of adi steps from a masked
+        start with point sources stays within 1e-3 of the max
+        concentration of the exact spectral solve, without overshooting
+    """
+    points = tuple(10 + np.random.RandomState(0).randint(-3, 4, (3, 30)))
+    C = dict()
+    for solver in ("adi", "spectral"):
+        g = Gradient("LIF", 10.0, 300.0, 300.0, 300.0, 15, 15, 15,
+                     outside_c = 0.5, solver = solver, dtype = np.float64)
+        shp = g.shape()
+        mask = np.zeros(shp)
+        mask[points] = 1
+        g.set_initial_conditions(mask)
+        source = np.zeros(shp)
+        np.add.at(source, points, 2e-20)
+        g.update(3600, np.zeros(shp), source)
+        C[solver] = g.C
+    scale = np.abs(C["spectral"]).max()
+    assert np.abs(C["adi"] - C["spectral"]).max() <= 1e-3*scale
+    assert C["adi"].max() <= 1.001*scale
+
+def test_nested_gradient_objects_outside_fine_level():
+    """ Objects past the fine level, on either side, are summed in to and
+        interpolated from the coarse voxels they lie in
+    """
+    g = NestedGradient("LIF", 10.0, 300.0, 300.0, 300.0, 15, 15, 15,
+                       45.0, 45.0, 45.0, outside_c = 0.5,
+                       dtype = np.float64)
+    #one object on the fine level, one just past each side of it and one
+    #several coarse voxels below it
+    distances = np.array([[0.0, 0.0, 0.0], [40.0, 0.0, 0.0],
+                          [0.0, -40.0, 0.0], [-100.0, -100.0, 70.0]])
+    pos = g.get_object_position_on_grid(distances)
+    weights = np.array([1.0, 2.0, 3.0, 4.0])
+    fine, coarse = g._levels(g.sum_at_grid_positions(pos, weights))
+    assert fine.sum() == 1.0
+    assert coarse.sum() == 9.0
+    coarse_pos = Gradient.get_object_position_on_grid(g, distances[1:])
+    for p, w in zip(coarse_pos.astype(int), weights[1:]):
+        assert coarse[tuple(p)] == w
+    #the objects' voxels start out masked on both levels
+    g.set_initial_conditions(g.sum_at_grid_positions(pos))
+    for p in coarse_pos.astype(int):
+        assert g.Ci[tuple(p)] == 0.0
+    source = g.sum_at_grid_positions(pos, 1e-18*weights)
+    g.update(3600, np.zeros(source.shape), source)
+    values = g.interpolate_at_grid_positions(pos)
+    assert np.all(values > 0.5)
+    assert np.allclose(values[1:],
+                       Gradient.interpolate_at_grid_positions(g, coarse_pos))
+    assert np.isclose(values[0], g.fine.interpolate_at_grid_positions(pos[:1]))